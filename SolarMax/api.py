@@ -0,0 +1,199 @@
+import json
+import time
+import threading
+import logging
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from SolarMax import metrics
+from SolarMax.codec import known_types
+from SolarMax.sample import Sample
+from SolarMax.solarmax import describe_status
+
+log = logging.getLogger("solarmax")
+
+
+# Latest value of every (host, inverter, register) with the time it was read, filled
+# by the logger after every run and by reads that had to go to the inverter.
+class SampleCache(object):
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SampleCache[devices=%s / ttl=%ss]' % (len(self.__values), self.ttl)
+
+    def update(self, sample):
+        timestamp = sample.timestamp / 1000.0
+        with self.__lock:
+            values = self.__values.setdefault((sample.host, sample.inverter), {})
+            for (register, value) in sample.items():
+                values[register] = (value, timestamp)
+
+    def get(self, host, inverter, registers=None):
+        # {register: (value, timestamp)}, all cached registers when registers is None
+        with self.__lock:
+            values = self.__values.get((host, inverter), {})
+            if registers is None:
+                return dict(values)
+            return dict((r, values[r]) for r in registers if r in values)
+
+    def fresh(self, host, inverter, registers, now=None):
+        # The cached values if all of them are younger than ttl, None otherwise
+        if now is None:
+            now = time.time()
+        values = self.get(host, inverter, registers)
+        if len(values) < len(registers):
+            return None
+        for (value, timestamp) in values.values():
+            if now - timestamp > self.ttl:
+                return None
+        return values
+
+
+# Concurrent calls with the same key share the result of the one call that runs
+class SingleFlight(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+
+    def do(self, key, function):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = function()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call['done'].set()
+        return call['result']
+
+
+# Answers reads from the cache while it is fresh. Otherwise one query goes to the
+# inverter through the session pool, shared by everybody asking for the same values.
+class ReadApi(object):
+    def __init__(self, pool, inverters, cache):
+        self.__pool = pool
+        self.__inverters = inverters
+        self.__flight = SingleFlight()
+        self.cache = cache
+
+    def __repr__(self):
+        return 'ReadApi[%s]' % self.cache
+
+    def devices(self):
+        return dict((host, list(devices)) for (host, devices) in self.__inverters.items())
+
+    def read(self, host, inverter, registers):
+        registers = tuple(sorted(set(registers)))
+        for register in registers:
+            if register not in known_types:
+                raise ValueError('Unknown register %s' % register)
+        if inverter not in self.__inverters.get(host, ()):
+            raise KeyError('Unknown inverter %s #%s' % (host, inverter))
+
+        values = self.cache.fresh(host, inverter, registers)
+        if values is not None:
+            metrics.api_cache_hits.inc()
+            return values
+        return self.__flight.do((host, inverter, registers), lambda: self.__query(host, inverter, registers))
+
+    def __query(self, host, inverter, registers):
+        metrics.api_queries.inc(host)
+        with self.__pool.session(host, self.__inverters[host]) as sm:
+            answer = sm.query(inverter, list(registers))
+        if not answer:
+            raise IOError('Inverter #%s on %s did not answer' % (inverter, host))
+        self.cache.update(Sample.from_answer(host, inverter, int(time.time() * 1000), registers, answer[1]))
+        return self.cache.get(host, inverter, registers)
+
+    def status(self, host, inverter):
+        values = self.read(host, inverter, ['SYS', 'SAL'])
+        (status, alarms) = describe_status(dict((r, v[0]) for (r, v) in values.items()))
+        return {'status': status, 'alarms': alarms, 'timestamp': min(v[1] for v in values.values())}
+
+
+def _values(values):
+    return dict((register, {'value': value, 'timestamp': timestamp})
+                for (register, (value, timestamp)) in values.items())
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    def __reply(self, code, body):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        api = self.server.api
+        try:
+            if url.path == '/devices':
+                self.__reply(200, api.devices())
+                return
+            if url.path not in ('/latest', '/status'):
+                self.__reply(404, {'error': 'Not found'})
+                return
+            if 'host' not in query or 'inverter' not in query:
+                self.__reply(400, {'error': 'host and inverter are required'})
+                return
+
+            host = query['host'][0]
+            inverter = int(query['inverter'][0])
+            if url.path == '/status':
+                self.__reply(200, api.status(host, inverter))
+            elif 'registers' in query:
+                registers = [r.strip().upper() for r in query['registers'][0].split(',') if r.strip()]
+                self.__reply(200, _values(api.read(host, inverter, registers)))
+            else:
+                # Whatever the logger read last, never goes to the inverter
+                self.__reply(200, _values(api.cache.get(host, inverter)))
+        except KeyError as e:
+            self.__reply(404, {'error': e.args[0]})
+        except ValueError as e:
+            self.__reply(400, {'error': str(e)})
+        except Exception as e:
+            log.debug("API read %s failed: %s", self.path, e)
+            self.__reply(503, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_api_server(address, port, api):
+    server = ApiServer((address, port), ApiHandler)
+    server.api = api
+    thread = threading.Thread(name="ApiServer", target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    log.info("Serving latest values on http://%s:%s/latest", address, port)
+    return server
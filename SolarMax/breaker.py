@@ -0,0 +1,89 @@
+import math
+import time
+import threading
+import logging
+
+from SolarMax import metrics
+
+log = logging.getLogger("solarmax")
+
+J2000 = 946728000  # 2000-01-01 12:00 UTC
+
+
+def solar_elevation(timestamp, latitude, longitude):
+    # Low precision solar position (about 0.01 degrees), plenty to tell day from night
+    d = (timestamp - J2000) / 86400.0
+    g = math.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    l = math.radians(q + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g))
+    e = math.radians(23.439 - 0.00000036 * d)
+    right_ascension = math.degrees(math.atan2(math.cos(e) * math.sin(l), math.cos(l)))
+    declination = math.asin(math.sin(e) * math.sin(l))
+    sidereal = (18.697374558 + 24.06570982441908 * d) * 15
+    hour_angle = math.radians(sidereal + longitude - right_ascension)
+    latitude = math.radians(latitude)
+    return math.degrees(math.asin(math.sin(latitude) * math.sin(declination) +
+                                  math.cos(latitude) * math.cos(declination) * math.cos(hour_angle)))
+
+
+# Keeps offline gateways from costing a connect timeout every run. After a run without
+# any answer a gateway is skipped for backoff seconds, doubled with every further failed
+# try up to max_backoff. A try is a connect first, the inverters are only queried once
+# the gateway accepts the connection. With coordinates no gateway is polled while the
+# sun is below min_elevation degrees.
+class CircuitBreaker(object):
+    def __init__(self, backoff=30, max_backoff=1800, latitude=None, longitude=None, min_elevation=-6):
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__latitude = latitude
+        self.__longitude = longitude
+        self.__min_elevation = min_elevation
+        self.__lock = threading.Lock()
+        self.__hosts = {}
+        self.__night = False
+
+    def __repr__(self):
+        return 'CircuitBreaker[backoff=%s..%ss / open=%s]' % (self.__backoff, self.__max_backoff,
+                                                             sorted(self.__hosts.keys()))
+
+    def daylight(self, now=None):
+        if self.__latitude is None or self.__longitude is None:
+            return True
+        if now is None:
+            now = time.time()
+        night = solar_elevation(now, self.__latitude, self.__longitude) < self.__min_elevation
+        if night != self.__night:
+            self.__night = night
+            log.info("Sun %s %s degrees, %s polling", "below" if night else "above", self.__min_elevation,
+                     "pausing" if night else "resuming")
+        return not night
+
+    def allow(self, host, now=None):
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            state = self.__hosts.get(host)
+        if state is None or now >= state[1]:
+            return True
+        log.debug("Skipping gateway %s for another %.0f seconds", host, state[1] - now)
+        metrics.skipped_polls.inc(host)
+        return False
+
+    def success(self, host):
+        with self.__lock:
+            state = self.__hosts.pop(host, None)
+        if state is not None:
+            log.info("Gateway %s answers again after %s failed tries", host, state[0])
+
+    def failure(self, host, now=None):
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            failures = self.__hosts.get(host, (0, 0))[0] + 1
+            delay = min(self.__backoff * 2 ** (failures - 1), self.__max_backoff)
+            self.__hosts[host] = (failures, now + delay)
+        log.info("Gateway %s did not answer (%s times), next try in %s seconds", host, failures, delay)
+
+    def hosts(self):
+        with self.__lock:
+            return sorted(self.__hosts.keys())
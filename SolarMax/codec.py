@@ -0,0 +1,142 @@
+# -* coding: utf-8 *-
+
+# Frame codec for the SolarMax protocol. Query frames are built once per
+# (inverter, registers, query type) and cached, values are decoded through a
+# register table instead of a chain of list lookups.
+
+import datetime
+
+query_types = ['KDY', 'KYR', 'KMT', 'KT0', 'IL1', 'IDC', 'PAC', 'PRL',
+               'SYS', 'SAL', 'TNF', 'PAC', 'PRL', 'TKK', 'UL1', 'UDC',
+               'ADR', 'TYP', 'PIN', 'MAC', 'CAC', 'KHR', 'EC00', 'EC01',
+               'EC02', 'EC03', 'EC04', 'EC05', 'EC06', 'EC07', 'EC08',
+               'BDN', 'SWV', 'DIN', 'LAN', 'SDAT', 'FDAT', 'KLD', 'KLM',
+               'KLY']
+
+known_types = frozenset(query_types)
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def hexval(i):
+    return '%X' % i
+
+
+def checksum(s):
+    if not isinstance(s, (bytes, bytearray)):
+        s = s.encode('latin-1')
+    return '%04X' % sum(bytearray(s))
+
+
+# Decoders for the raw hex values of the registers
+def decode_int(value):
+    return int(value, 16)
+
+
+def decode_scaled(divisor):
+    def decode(value):
+        return float(int(value, 16)) / divisor
+    return decode
+
+
+def decode_pair(value):
+    (x, y) = value.split(',', 2)
+    return (int(x, 16), int(y, 16))
+
+
+def decode_datetime(value):
+    (date, time) = value.split(',', 2)
+    time = int(time, 16)
+    return datetime.datetime(int(date[:3], 16), int(date[3:5], 16), int(date[5:], 16), time // 3600,
+                             (time % 3600) // 60, time % 60)
+
+
+# register -> (type, divisor); registers not listed are plain hex integers. The raw value
+# of a float register is the value times divisor.
+register_table = {}
+for (keys, value_type, divisor) in [
+        (['KDY', 'KLD', 'UL1', 'UDC'], float, 10),
+        (['IL1', 'IDC', 'TNF'], float, 100),
+        (['PAC', 'PIN'], float, 2),
+        (['SYS'], tuple, None),
+        (['SDAT', 'FDAT'], datetime.datetime, None)]:
+    for key in keys:
+        register_table[key] = (value_type, divisor)
+
+
+def decoder_of(value_type, divisor=None):
+    if value_type is float:
+        return decode_scaled(divisor)
+    if value_type is tuple:
+        return decode_pair
+    if value_type is datetime.datetime:
+        return decode_datetime
+    return decode_int
+
+
+decoders = dict((key, decoder_of(*entry)) for (key, entry) in register_table.items())
+
+def normalize_value(key, value):
+    return decoders.get(key, decode_int)(value)
+
+
+_query_cache = {}
+
+
+def build_query(id, values, qtype=100):
+    if type(values) == list:
+        key = (id, tuple(values), qtype)
+        query = _query_cache.get(key)
+        if query is not None:
+            return query
+        for v in values:
+            if v not in known_types:
+                raise ValueError('Unknown data type »' + v + '«')
+        query = _query_cache[key] = encode_query(id, ';'.join(values), qtype)
+        return query
+    elif type(values) in [str, unicode]:
+        # Settings carry their values, those frames are not worth caching
+        return encode_query(id, values, qtype)
+    else:
+        raise ValueError('Value has unsupported type')
+
+
+def encode_query(id, values, qtype):
+    querystring = '|' + hexval(qtype) + ':' + values + '|'
+    # Length enlarge: 2 x {(2), WR number (2), "FB" (2) two semicolon (2), length itself (2), checksum (4)
+    l = len(querystring) + 2 + 2 + 2 + 2 + 2 + 4
+    querystring = 'FB;%s;%s%s' % (hexval(id), hexval(l), querystring)
+    return '{%s%s}' % (querystring, checksum(querystring))
+
+
+def parse_answer(answer, decode=False):
+    # convenience checks
+    if not answer or answer[0] != '{' or answer[-1] != '}':
+        raise ValueError('Malformed answer: %s' % answer)
+    content = answer[1:-5]
+    # checksum
+    if answer[-5:-1] != checksum(content):
+        raise ChecksumError('Checksum error')
+
+    (header, content) = content[:-1].split('|', 1)
+    (inverter, fb, length) = header.split(';', 2)
+    if fb != 'FB':
+        raise ValueError('Answer not understood')
+    # length
+    if int(length, 16) != len(answer):
+        raise ValueError('Length mismatch')
+
+    # With write access to the WR responds with 'C8'
+    # if not content.startswith('64:'):
+    #  raise ValueError('Inverter did not understand our query')
+
+    data = {}
+    get = decoders.get
+    for item in content[3:].split(';'):
+        (key, value) = item.split('=')
+        if key not in known_types:
+            raise NotImplementedError("Don't know %s" % item)
+        data[key] = get(key, decode_int)(value) if decode else value
+    return (int(inverter, 16), data)
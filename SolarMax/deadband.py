@@ -0,0 +1,73 @@
+import logging
+
+from SolarMax import metrics
+
+log = logging.getLogger("solarmax")
+
+# SYS states in which an inverter does not feed in
+idle_status_codes = frozenset([20000, 20002, 20003, 20013, 20016, 20017, 20018, 20019, 20021, 20022, 20023,
+                               20024, 20115, 20165])
+
+
+def parse_deadbands(items):
+    # <register> = <absolute>[, <relative>%]
+    deadbands = {}
+    for (register, value) in items:
+        parts = [p.strip() for p in value.split(',')]
+        absolute = float(parts[0]) if parts[0] else 0.0
+        relative = float(parts[1].rstrip('%')) / 100 if len(parts) > 1 else 0.0
+        deadbands[register.upper()] = (absolute, relative)
+    return deadbands
+
+
+# Keeps the last written value of every series and only lets values through that moved
+# out of their deadband, or that were not written for heartbeat seconds. Registers in
+# idle_registers are not polled at all while SYS says the inverter does not feed in.
+class ChangeFilter(object):
+    def __init__(self, deadbands=None, heartbeat=900, idle_registers=()):
+        self.__deadbands = deadbands or {}
+        self.__heartbeat = heartbeat * 1000
+        self.__idle_registers = frozenset(idle_registers)
+        self.__last = {}
+        self.__idle = {}
+
+    def __repr__(self):
+        return 'ChangeFilter[series=%s / heartbeat=%ss / idle=%s]' % (
+            len(self.__last), self.__heartbeat // 1000, ','.join(sorted(self.__idle_registers)))
+
+    def registers(self, host, inverter, registers):
+        if not self.__idle.get((host, inverter)):
+            return registers
+        return [r for r in registers if r not in self.__idle_registers]
+
+    def __changed(self, register, old, new):
+        deadband = self.__deadbands.get(register)
+        if deadband is None or not isinstance(new, (int, long, float)):
+            return new != old
+        difference = abs(new - old)
+        return difference > deadband[0] and difference > deadband[1] * abs(old)
+
+    def filter(self, host, inverter, current, timestamp):
+        # timestamp in milliseconds, returns the (register, value) pairs of current that are to be written
+        force = False
+        status = current.get('SYS')
+        if status is not None:
+            idle = status[0] in idle_status_codes
+            if idle != self.__idle.get((host, inverter), False):
+                # Write everything when the inverter starts or stops feeding in, so the
+                # paused series end on their real last value
+                log.info("Inverter %s on %s %s", inverter, host, "stopped feeding in" if idle else "feeds in")
+                force = True
+            self.__idle[(host, inverter)] = idle
+
+        changed = []
+        for (register, value) in current.items():
+            key = (host, inverter, register)
+            last = self.__last.get(key)
+            if (force or last is None or timestamp - last[1] >= self.__heartbeat
+                    or self.__changed(register, last[0], value)):
+                self.__last[key] = (value, timestamp)
+                changed.append((register, value))
+            else:
+                metrics.filtered_points.inc()
+        return changed
@@ -0,0 +1,67 @@
+import os
+import json
+import threading
+import time
+import logging
+
+log = logging.getLogger("solarmax")
+
+
+# Remembers type and installed power of every detected inverter per (host, device id),
+# so a reconnect or restart does not have to send ADR;TYP;PIN to every device again.
+# Entries expire after ttl seconds and are dropped on real errors (type mismatch,
+# repeated timeouts).
+class DiscoveryCache(object):
+    def __init__(self, path=None, ttl=24 * 3600):
+        self.__path = path
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.__entries = json.load(f)
+                log.info("Loaded %s known inverters from %s", len(self.__entries), path)
+            except (IOError, ValueError) as e:
+                log.info("Ignoring unreadable discovery state %s: %s", path, e)
+
+    def __repr__(self):
+        return 'DiscoveryCache[%s / entries=%s / ttl=%s]' % (self.__path, len(self.__entries), self.__ttl)
+
+    def __key(self, host, inverter):
+        return '%s/%s' % (host, inverter)
+
+    def __save(self):
+        # Called with the lock held, replaces the state file in one step
+        if not self.__path:
+            return
+        tmp = self.__path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.__entries, f)
+            os.rename(tmp, self.__path)
+        except (IOError, OSError) as e:
+            log.warning("Could not save discovery state to %s: %s", self.__path, e)
+
+    def get(self, host, inverter):
+        with self.__lock:
+            entry = self.__entries.get(self.__key(host, inverter))
+        if entry is None or time.time() - entry['detected'] > self.__ttl:
+            return None
+        return entry
+
+    def put(self, host, inverter, inverter_type, power_installed):
+        with self.__lock:
+            key = self.__key(host, inverter)
+            old = self.__entries.get(key)
+            self.__entries[key] = {'type': inverter_type, 'power_installed': power_installed,
+                                   'detected': time.time()}
+            if old is not None and old['type'] != inverter_type:
+                log.info("Inverter #%s on %s changed type from %s to %s", inverter, host, old['type'], inverter_type)
+            self.__save()
+
+    def invalidate(self, host, inverter):
+        with self.__lock:
+            if self.__entries.pop(self.__key(host, inverter), None) is not None:
+                log.info("Forgetting inverter #%s on %s", inverter, host)
+                self.__save()
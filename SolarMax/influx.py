@@ -0,0 +1,149 @@
+import threading
+import time
+import zlib
+import base64
+import logging
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from SolarMax import metrics
+
+log = logging.getLogger("solarmax")
+
+
+class LineProtocolError(Exception):
+    def __init__(self, code, content):
+        Exception.__init__(self, '%s: %s' % (code, content))
+        self.code = code
+        self.content = content
+
+
+# Minimal InfluxDB 1.x client for line protocol writes on one keep-alive HTTP connection,
+# without the dependencies influxdb.InfluxDBClient pulls in at startup.
+class LineProtocolClient(object):
+    def __init__(self, host, port, user, password, database, gzip=True, timeout=30):
+        self.__host = host
+        self.__port = int(port)
+        self.__path = '/write?' + urlencode({'db': database})
+        self.__headers = {'Content-Type': 'application/octet-stream'}
+        if user:
+            credentials = ('%s:%s' % (user, password)).encode('utf-8')
+            self.__headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        if gzip:
+            self.__headers['Content-Encoding'] = 'gzip'
+        self.__gzip = gzip
+        self.__timeout = timeout
+        self.__connection = None
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'LineProtocolClient[%s:%s%s]' % (self.__host, self.__port, self.__path)
+
+    def __connect(self):
+        try:
+            from httplib import HTTPConnection
+        except ImportError:
+            from http.client import HTTPConnection
+        return HTTPConnection(self.__host, self.__port, timeout=self.__timeout)
+
+    def write_points(self, points, time_precision='ms', protocol='line'):
+        body = ('\n'.join(points) + '\n').encode('utf-8')
+        if self.__gzip:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        with self.__lock:
+            if self.__connection is None:
+                self.__connection = self.__connect()
+            try:
+                self.__connection.request('POST', '%s&precision=%s' % (self.__path, time_precision), body,
+                                          self.__headers)
+                response = self.__connection.getresponse()
+                content = response.read()
+            except Exception:
+                # Start over with a new connection on the next write
+                self.__connection.close()
+                self.__connection = None
+                raise
+        if response.status != 204:
+            raise LineProtocolError(response.status, content)
+        return True
+
+
+def create_client(client, host, port, user, password, database, gzip=True):
+    if client == 'http':
+        return LineProtocolClient(host, port, user, password, database, gzip)
+    if client == 'influxdb':
+        # Only loaded when asked for, it takes a while to import on small boards
+        from influxdb import InfluxDBClient
+        return InfluxDBClient(host, port, user, password, database, gzip=gzip)
+    raise ValueError('Unknown InfluxDB client %s' % client)
+
+
+# Collects line protocol points and sends them in batches over one long-lived client,
+# instead of one HTTP request per measurement.
+class InfluxWriter(object):
+    def __init__(self, host, port, user, password, database, batch_size=5000, flush_interval=0, gzip=True,
+                 client='influxdb'):
+        self.__client = create_client(client, host, port, user, password, database, gzip)
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__lines = []
+        self.__lock = threading.Lock()
+        self.__last_flush = time.time()
+
+    def configure(self, client, batch_size=5000, flush_interval=0):
+        # client as built by create_client. Points collected so far go to the old database,
+        # everything after to the new one
+        self.flush()
+        with self.__lock:
+            self.__client = client
+            self.__batch_size = batch_size
+            self.__flush_interval = flush_interval
+        log.info("Database settings changed: %s", self)
+
+    def __repr__(self):
+        return 'InfluxWriter[pending=%s / batch_size=%s / flush_interval=%s]' % (
+            len(self.__lines), self.__batch_size, self.__flush_interval)
+
+    def add(self, lines):
+        with self.__lock:
+            self.__lines.extend(lines)
+            full = len(self.__lines) >= self.__batch_size
+        if full:
+            self.flush()
+
+    def flush_due(self):
+        if time.time() - self.__last_flush >= self.__flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.__lock:
+            lines = self.__lines
+            self.__lines = []
+        self.__last_flush = time.time()
+
+        sent = 0
+        for start in range(0, len(lines), self.__batch_size):
+            batch = lines[start:start + self.__batch_size]
+            try:
+                response = self.write(batch)
+            except Exception as e:
+                log.exception("Exception happened sending %s points to database: %s", len(batch), e)
+                continue
+            if response is not True:
+                log.error("Something went wrong sending %s points to database.", len(batch))
+                continue
+            sent += len(batch)
+        if lines:
+            log.info("Sent %s of %s points to database", sent, len(lines))
+        return sent
+
+    def write(self, lines):
+        start = time.time()
+        try:
+            return self.__client.write_points(lines, time_precision='ms', protocol='line')
+        finally:
+            metrics.write_seconds.observe(time.time() - start)
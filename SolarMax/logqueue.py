@@ -0,0 +1,71 @@
+import threading
+import logging
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Non-blocking logging: QueueHandler puts records on a queue, QueueListener writes them
+# to the real handlers on its own thread, so slow disks and log rotation never hold up
+# the polling threads. Python 2 has no logging.handlers.QueueHandler, hence these.
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.queue = records
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge the arguments now, they may change once the caller moves on. Exception
+        # text is rendered now as well, the traceback only lives as long as the handler.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            # Rather lose a log line than stall a poll
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    def __init__(self, records, *handlers):
+        self.queue = records
+        self.handlers = handlers
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(name="LogListener", target=self.__monitor)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def __monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        if self.__thread is not None:
+            self.queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+
+def queue_logging(handlers, maxsize=10000):
+    records = queue.Queue(maxsize)
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    return (QueueHandler(records), listener)
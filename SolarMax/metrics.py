@@ -0,0 +1,143 @@
+import threading
+import logging
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+log = logging.getLogger("solarmax")
+
+# Bucket bounds in seconds, from a fast local round trip up to the socket timeout
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('"', '\\"')) for (n, v) in zip(names, values))
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Counter[%s]' % self.name
+
+    def inc(self, *labels):
+        with self.__lock:
+            self.__values[labels] = self.__values.get(labels, 0) + 1
+
+    def value(self, *labels):
+        return self.__values.get(labels, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.__lock:
+            for (labels, value) in sorted(self.__values.items()):
+                lines.append('%s%s %s' % (self.name, _labels(self.labels, labels), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Histogram[%s]' % self.name
+
+    def observe(self, value, *labels):
+        with self.__lock:
+            entry = self.__values.get(labels)
+            if entry is None:
+                entry = self.__values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            counts = entry[0]
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def count(self, *labels):
+        entry = self.__values.get(labels)
+        return entry[1] if entry else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        names = tuple(self.labels) + ('le',)
+        with self.__lock:
+            for (labels, (counts, count, total)) in sorted(self.__values.items()):
+                for (bound, bucket) in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %s' % (self.name, _labels(names, labels + (bound,)), bucket))
+                lines.append('%s_bucket%s %s' % (self.name, _labels(names, labels + ('+Inf',)), count))
+                lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, labels), total))
+                lines.append('%s_count%s %s' % (self.name, _labels(self.labels, labels), count))
+        return lines
+
+
+connect_seconds = Histogram('solarmax_connect_seconds', 'Time to connect to a gateway', ('host',))
+query_seconds = Histogram('solarmax_query_seconds', 'Round trip of a query to an inverter', ('host', 'inverter'))
+parse_seconds = Histogram('solarmax_parse_seconds', 'Time to parse and normalize an answer', ('host',))
+write_seconds = Histogram('solarmax_influxdb_write_seconds', 'Latency of a write to InfluxDB')
+cycle_seconds = Histogram('solarmax_cycle_seconds', 'Duration of a logger run')
+timeouts = Counter('solarmax_timeouts_total', 'Queries without answer', ('host',))
+checksum_errors = Counter('solarmax_checksum_errors_total', 'Answers with a wrong checksum', ('host',))
+reconnects = Counter('solarmax_reconnects_total', 'Connections opened again after the first one', ('host',))
+redetections = Counter('solarmax_redetections_total', 'Detections of the inverters behind a gateway', ('host',))
+skipped_polls = Counter('solarmax_skipped_polls_total', 'Runs a gateway was skipped while backing off', ('host',))
+api_cache_hits = Counter('solarmax_api_cache_hits_total', 'API reads answered from the latest samples')
+api_queries = Counter('solarmax_api_queries_total', 'Queries sent to inverters for API reads', ('host',))
+filtered_points = Counter('solarmax_filtered_points_total', 'Values not written because they did not change')
+
+registry = [connect_seconds, query_seconds, parse_seconds, write_seconds, cycle_seconds, timeouts,
+            checksum_errors, reconnects, redetections, skipped_polls, filtered_points,
+            api_cache_hits, api_queries]
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the log otherwise
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(address, port):
+    server = MetricsServer((address, port), MetricsHandler)
+    thread = threading.Thread(name="MetricsServer", target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    log.info("Serving metrics on http://%s:%s/metrics", address, port)
+    return server
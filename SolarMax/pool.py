@@ -0,0 +1,80 @@
+import threading
+import logging
+from contextlib import contextmanager
+
+from SolarMax.solarmax import SolarMax
+
+log = logging.getLogger("solarmax")
+
+
+# Long-lived SolarMax sessions keyed by gateway host. Sessions are borrowed for a run and
+# handed back afterwards, so the TCP connection and the detected inverters are reused.
+class SessionPool(object):
+    def __init__(self, port=12345, max_sessions=1, discovery=None):
+        self.__port = port
+        self.__max_sessions = max_sessions
+        self.__discovery = discovery
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__slots = {}
+
+    def __repr__(self):
+        return 'SessionPool[port=%s / hosts=%s]' % (self.__port, sorted(self.__slots.keys()))
+
+    def __slot(self, host):
+        with self.__lock:
+            if host not in self.__slots:
+                self.__slots[host] = threading.BoundedSemaphore(self.__max_sessions)
+                self.__idle[host] = []
+            return self.__slots[host]
+
+    def __checkout(self, host, devices):
+        with self.__lock:
+            idle = self.__idle[host]
+            sm = idle.pop() if idle else None
+
+        if sm is None:
+            sm = SolarMax(host, self.__port, self.__discovery)
+            # Detection is postponed to the first inverters() call while the gateway is dark
+            sm.use_inverters(devices, detect=sm.connected())
+        elif sm.inverter_list() != devices:
+            # Every session of the gateway keeps its own list, each one picks up a change
+            sm.use_inverters(devices)
+        elif not sm.alive():
+            log.info("Idle connection to %s is gone, reconnecting", host)
+            sm.reconnect()
+        return sm
+
+    @contextmanager
+    def session(self, host, devices):
+        slot = self.__slot(host)
+        slot.acquire()
+        sm = None
+        try:
+            sm = self.__checkout(host, devices)
+            yield sm
+        finally:
+            if sm is not None:
+                with self.__lock:
+                    if host in self.__idle:
+                        self.__idle[host].append(sm)
+                        sm = None
+                if sm is not None:
+                    # Host was removed from the pool while the session was borrowed
+                    sm.close()
+            slot.release()
+
+    def remove(self, host):
+        with self.__lock:
+            idle = self.__idle.pop(host, [])
+            self.__slots.pop(host, None)
+        for sm in idle:
+            sm.close()
+
+    def hosts(self):
+        with self.__lock:
+            return list(self.__slots.keys())
+
+    def close(self):
+        for host in self.hosts():
+            self.remove(host)
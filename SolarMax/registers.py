@@ -0,0 +1,66 @@
+import math
+import time
+import logging
+from fractions import gcd
+
+from SolarMax.codec import known_types
+
+log = logging.getLogger("solarmax")
+
+# Registers polled when solarmax_logger.conf has no [registers] section
+default_groups = [('default', 60, ['PAC', 'UL1', 'TKK', 'KDY', 'KMT', 'KYR', 'KT0'])]
+
+
+class RegisterGroup(object):
+    def __init__(self, name, interval, registers):
+        for register in registers:
+            if register not in known_types:
+                raise ValueError('Unknown register %s in register group %s' % (register, name))
+        if interval < 1:
+            raise ValueError('Interval of register group %s must be at least 1 second' % name)
+        self.name = name
+        self.interval = interval
+        self.registers = registers
+        self.next_due = 0
+
+    def __repr__(self):
+        return 'RegisterGroup[%s / every %ss / %s]' % (self.name, self.interval, ','.join(self.registers))
+
+
+def parse_register_groups(items):
+    # <group> = <interval in seconds>: <register>,<register>,...
+    groups = []
+    for (name, value) in items:
+        (interval, registers) = value.split(':', 1)
+        registers = [r.strip().upper() for r in registers.split(',') if r.strip()]
+        groups.append(RegisterGroup(name, int(interval), registers))
+    return groups
+
+
+# Decides which registers are due. Registers of all groups that are due at the same
+# time are merged, so every device gets one query frame per run.
+class RegisterSchedule(object):
+    def __init__(self, groups=None):
+        if not groups:
+            groups = [RegisterGroup(name, interval, registers) for (name, interval, registers) in default_groups]
+        self.groups = groups
+
+    def __repr__(self):
+        return 'RegisterSchedule[%s]' % ', '.join(repr(g) for g in self.groups)
+
+    def period(self):
+        return reduce(gcd, [g.interval for g in self.groups])
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        registers = []
+        for group in self.groups:
+            # next_due sits on a multiple of the group interval, groups whose boundary
+            # passed during a skipped run are picked up by the next one
+            if now >= group.next_due:
+                group.next_due = (math.floor(now / group.interval) + 1) * group.interval
+                for register in group.registers:
+                    if register not in registers:
+                        registers.append(register)
+        return registers
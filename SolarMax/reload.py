@@ -0,0 +1,49 @@
+import os
+import logging
+
+import configparser
+
+log = logging.getLogger("solarmax")
+
+
+# Reads the configuration file again when it was modified or a reload was requested
+# (request() doubles as SIGHUP handler) and hands the old and the new configuration
+# to apply. A file that cannot be applied leaves the running configuration in place.
+class ConfigWatcher(object):
+    def __init__(self, path, config, apply):
+        self.__path = path
+        self.__apply = apply
+        self.__requested = False
+        self.__mtime = self.__stat()
+        self.config = config
+
+    def __repr__(self):
+        return 'ConfigWatcher[%s]' % self.__path
+
+    def __stat(self):
+        try:
+            return os.stat(self.__path).st_mtime
+        except OSError:
+            return None
+
+    def request(self, *args):
+        self.__requested = True
+
+    def check(self):
+        mtime = self.__stat()
+        if not self.__requested and mtime == self.__mtime:
+            return False
+        self.__requested = False
+        self.__mtime = mtime
+
+        log.info("Reloading configuration from %s", self.__path)
+        config = configparser.ConfigParser()
+        try:
+            if not config.read([self.__path]):
+                raise IOError("Cannot read %s" % self.__path)
+            self.__apply(self.config, config)
+        except Exception as e:
+            log.error("Configuration not reloaded, keeping the running one: %s", e)
+            return False
+        self.config = config
+        return True
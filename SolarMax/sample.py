@@ -0,0 +1,77 @@
+import logging
+
+log = logging.getLogger("solarmax")
+
+
+# The answer of one inverter in one run. The registers tuple is shared by all samples
+# of a query, values are kept in the same order.
+class Sample(object):
+    __slots__ = ('host', 'inverter', 'timestamp', 'registers', 'values')
+
+    def __init__(self, host, inverter, timestamp, registers=(), values=()):
+        self.host = host
+        self.inverter = inverter
+        self.timestamp = timestamp
+        self.registers = registers
+        self.values = values
+
+    @classmethod
+    def from_answer(cls, host, inverter, timestamp, registers, answer):
+        return cls(host, inverter, timestamp, registers, [answer.get(r) for r in registers])
+
+    def __repr__(self):
+        return 'Sample[%s / #%s / %s / %s]' % (self.host, self.inverter, self.timestamp, dict(self.items()))
+
+    def __len__(self):
+        return len(self.registers)
+
+    def get(self, register, default=None):
+        if register in self.registers:
+            value = self.values[self.registers.index(register)]
+            if value is not None:
+                return value
+        return default
+
+    def items(self):
+        return [(r, v) for (r, v) in zip(self.registers, self.values) if v is not None]
+
+
+# Encodes samples to line protocol. The part in front of the value only depends on
+# (host, inverter, register) and is built once; lines go to a buffer that is reused
+# from run to run.
+class LineEncoder(object):
+    def __init__(self, location, names):
+        self.__location = location
+        self.__names = names
+        self.__prefixes = {}
+        self.buffer = []
+
+    def __repr__(self):
+        return 'LineEncoder[%s / prefixes=%s / lines=%s]' % (self.__location, len(self.__prefixes),
+                                                             len(self.buffer))
+
+    def __prefix(self, host, inverter, register):
+        key = (host, inverter, register)
+        prefix = self.__prefixes.get(key)
+        if prefix is None:
+            (measurement, field) = self.__names.get(register, (register.lower(), 'value'))
+            prefix = self.__prefixes[key] = '%s,host_ip=%s,inverter=%s,location=%s %s=' % (
+                measurement, host, inverter, self.__location, field)
+        return prefix
+
+    def set_location(self, location):
+        self.__location = location
+        self.__prefixes = {}
+
+    def clear(self):
+        del self.buffer[:]
+
+    def encode(self, sample, items=None):
+        # items defaults to all values of the sample
+        if items is None:
+            items = sample.items()
+        suffix = ' %s' % sample.timestamp
+        for (register, value) in items:
+            if register == 'SYS':
+                value = value[0]
+            self.buffer.append(self.__prefix(sample.host, sample.inverter, register) + str(float(value)) + suffix)
@@ -0,0 +1,45 @@
+import math
+import time
+import logging
+
+log = logging.getLogger("solarmax")
+
+
+# Fires runs on wall-clock boundaries that are a multiple of period (e.g. :00 of every
+# minute for 60 seconds). Sleeps exactly until the next boundary; boundaries that passed
+# while a run was still busy are skipped and counted instead of being run late.
+class AlignedScheduler(object):
+    def __init__(self, period):
+        self.period = period
+        self.missed = 0
+        self.__next = self.boundary_after(time.time())
+
+    def __repr__(self):
+        return 'AlignedScheduler[period=%ss / missed=%s]' % (self.period, self.missed)
+
+    def boundary_after(self, now):
+        return (math.floor(now / self.period) + 1) * self.period
+
+    def next_run(self):
+        return self.__next
+
+    def wait(self):
+        now = time.time()
+        # A run that ends just after the boundary still starts the next one, anything later
+        # than a tenth of the period means the boundary was missed.
+        if now > self.__next + self.period * 0.1:
+            skipped = int((now - self.__next) // self.period) + 1
+            self.missed += skipped
+            self.__next = self.boundary_after(now)
+            log.info("Run took too long, skipped %s deadlines (%s in total)", skipped, self.missed)
+
+        # time.sleep may return early, sleep again for the rest
+        while True:
+            remaining = self.__next - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(remaining)
+
+        tick = self.__next
+        self.__next = tick + self.period
+        return tick
@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+
+# Local simulator of SolarMax gateways, speaking the {FB;..|64:...|CSUM} protocol on TCP.
+# Every gateway serves any number of device ids and can add latency, jitter, dropped
+# or corrupted answers, or refuse connections as a dark gateway does at night.
+#
+#   python -m SolarMax.simulator --gateways 4 --devices 3 --latency 0.05
+
+import math
+import random
+import socket
+import threading
+import time
+import logging
+
+import click
+
+from SolarMax import codec
+from SolarMax.solarmax import FrameReader
+
+log = logging.getLogger("solarmax.simulator")
+
+SM10MT2 = 20210
+
+
+class SimulatedInverter(object):
+    def __init__(self, address, power_installed=10000):
+        self.address = address
+        self.power_installed = power_installed
+        self.started = time.time()
+        self.energy_total = 10000 + address * 1000
+
+    def values(self, now):
+        # A day in ten minutes of simulated time, so PAC and the counters move in benchmarks
+        phase = (now - self.started) / 600.0 * 2 * math.pi
+        pac = max(0.0, math.sin(phase)) * self.power_installed * random.uniform(0.9, 1.0)
+        producing = int(pac * 2) > 0
+        udc = 600.0 + random.uniform(-5, 5) if producing else 0.0
+        idc = pac / udc if udc else 0.0
+        kdy = (1 - math.cos(phase % math.pi)) * self.power_installed / 1000.0 * 2
+        stamp = time.localtime(now)
+        return {
+            'ADR': '%X' % self.address,
+            'TYP': '%X' % SM10MT2,
+            'PIN': '%X' % (self.power_installed * 2),
+            'PAC': '%X' % int(pac * 2),
+            'PRL': '%X' % int(pac * 100 / self.power_installed),
+            'UL1': '%X' % int(2300 + random.randint(-30, 30)),
+            'UDC': '%X' % int(udc * 10),
+            'IDC': '%X' % int(idc * 100),
+            'IL1': '%X' % int(pac / 230.0 * 100),
+            'TNF': '%X' % (5000 + random.randint(-5, 5)),
+            'TKK': '%X' % (25 + int(pac / self.power_installed * 30)),
+            'KDY': '%X' % int(kdy * 10),
+            'KLD': '%X' % (40 * 10),
+            'KMT': '%X' % (300 + int(kdy)),
+            'KLM': '%X' % 900,
+            'KYR': '%X' % (4000 + int(kdy)),
+            'KLY': '%X' % 11000,
+            'KT0': '%X' % (self.energy_total + int(kdy)),
+            'KHR': '%X' % 20000,
+            'CAC': '%X' % 1500,
+            'SYS': '%X,0' % (20004 if producing else 20002),
+            'SAL': '0',
+            'SDAT': '%03X%02X%02X,%X' % (stamp.tm_year, stamp.tm_mon, stamp.tm_mday,
+                                         stamp.tm_hour * 3600 + stamp.tm_min * 60 + stamp.tm_sec),
+        }
+
+
+def encode_answer(address, content):
+    content = '|' + content + '|'
+    # {(1) address(2) ;FB;(4) length(2) content checksum(4) }(1)
+    frame = '%02X;FB;%02X%s' % (address, len(content) + 14, content)
+    return '{%s%s}' % (frame, codec.checksum(frame))
+
+
+class SimulatedGateway(object):
+    def __init__(self, host='127.0.0.1', port=12345, devices=(1,), latency=0.0, jitter=0.0, drop_rate=0.0,
+                 corrupt_rate=0.0):
+        self.host = host
+        self.port = port
+        self.inverters = dict((address, SimulatedInverter(address)) for address in devices)
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.queries = 0
+        self.__listener = None
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SimulatedGateway[%s:%s / devices=%s / night=%s]' % (
+            self.host, self.port, sorted(self.inverters.keys()), self.night())
+
+    def night(self):
+        return self.__listener is None
+
+    def set_night(self, night):
+        # At night the gateway is switched off: open connections drop and new ones are refused
+        if night and self.__listener is not None:
+            listener = self.__listener
+            self.__listener = None
+            # shutdown wakes up the thread blocked in accept(), close alone does not
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            listener.close()
+            with self.__lock:
+                connections = self.__connections
+                self.__connections = []
+            for conn in connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                    conn.close()
+                except socket.error:
+                    pass
+        elif not night and self.__listener is None:
+            self.start()
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(16)
+        self.__listener = listener
+        thread = threading.Thread(name="sim-{}:{}".format(self.host, self.port), target=self.__accept,
+                                  args=[listener])
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def __accept(self, listener):
+        while True:
+            try:
+                (conn, address) = listener.accept()
+            except socket.error:
+                return
+            with self.__lock:
+                self.__connections.append(conn)
+            thread = threading.Thread(name="sim-{}:{}-conn".format(self.host, self.port), target=self.__serve,
+                                      args=[conn])
+            thread.setDaemon(True)
+            thread.start()
+
+    def __serve(self, conn):
+        reader = FrameReader(conn)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if not frame:
+                    break
+                answer = self.answer(frame)
+                if answer is None:
+                    continue
+                delay = self.latency + random.uniform(0, self.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                conn.sendall(answer)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            with self.__lock:
+                if conn in self.__connections:
+                    self.__connections.remove(conn)
+            conn.close()
+
+    def answer(self, frame):
+        # {FB;<address>;<length>|<qtype>:<registers>|<checksum>}
+        if frame[:1] != '{' or frame[-1:] != '}' or frame[-5:-1] != codec.checksum(frame[1:-5]):
+            return None
+        try:
+            (header, content) = frame[1:-6].split('|', 1)
+            (fb, address, length) = header.split(';', 2)
+            (qtype, registers) = content.split(':', 1)
+            address = int(address, 16)
+        except ValueError:
+            return None
+
+        # An address that is not on the bus simply stays silent
+        inverter = self.inverters.get(address)
+        if inverter is None:
+            return None
+        self.queries += 1
+        if random.random() < self.drop_rate:
+            return None
+
+        if qtype == '64':
+            values = inverter.values(time.time())
+            content = '64:' + ';'.join('%s=%s' % (r, values.get(r, '0')) for r in registers.split(';'))
+        else:
+            content = 'C8:' + registers
+        answer = encode_answer(address, content)
+        if random.random() < self.corrupt_rate:
+            position = random.randrange(1, len(answer) - 1)
+            answer = answer[:position] + chr(ord(answer[position]) ^ 0x01) + answer[position + 1:]
+        return answer
+
+
+class Simulator(object):
+    def __init__(self, hosts, port=12345, devices=(1,), **options):
+        self.gateways = [SimulatedGateway(host, port, devices, **options) for host in hosts]
+
+    def __repr__(self):
+        return 'Simulator[%s]' % ', '.join(repr(g) for g in self.gateways)
+
+    def start(self):
+        for gateway in self.gateways:
+            gateway.start()
+        return self
+
+    def queries(self):
+        return sum(g.queries for g in self.gateways)
+
+    def set_night(self, night):
+        for gateway in self.gateways:
+            gateway.set_night(night)
+
+
+def loopback_hosts(count, prefix='127.0.1.'):
+    # Linux answers on all of 127.0.0.0/8, so every gateway gets its own address on the default port
+    return ['%s%d' % (prefix, n) for n in range(1, count + 1)]
+
+
+@click.command()
+@click.option("--gateways", default=1, help="Number of gateways, each on its own loopback address")
+@click.option("--devices", default=2, help="Number of devices per gateway (ids 1..n)")
+@click.option("--port", default=12345, help="TCP port of the gateways")
+@click.option("--latency", default=0.0, help="Seconds before every answer")
+@click.option("--jitter", default=0.0, help="Random extra seconds before every answer")
+@click.option("--drop-rate", default=0.0, help="Fraction of queries that get no answer")
+@click.option("--corrupt-rate", default=0.0, help="Fraction of answers with a flipped bit")
+def main(gateways, devices, port, latency, jitter, drop_rate, corrupt_rate):
+    logging.basicConfig(level=logging.INFO)
+    hosts = ['127.0.0.1'] if gateways == 1 else loopback_hosts(gateways)
+    simulator = Simulator(hosts, port, range(1, devices + 1), latency=latency, jitter=jitter,
+                          drop_rate=drop_rate, corrupt_rate=corrupt_rate).start()
+    log.info("Running %s", simulator)
+    while True:
+        time.sleep(60)
+        log.info("%s queries answered", simulator.queries())
+
+
+if __name__ == '__main__':
+    main()
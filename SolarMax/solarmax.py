@@ -19,9 +19,14 @@
 
 
 import socket
-import datetime
+import select
+import time
 import logging
 
+from SolarMax import codec
+from SolarMax import metrics
+from SolarMax.codec import query_types
+
 log = logging.getLogger("solarmax")
 
 # Constants - range of Inverters supported
@@ -29,13 +34,6 @@ inverter_types = {
     20210: {'description': 'SolarMax SM10MT2', },
 }
 
-query_types = ['KDY', 'KYR', 'KMT', 'KT0', 'IL1', 'IDC', 'PAC', 'PRL',
-               'SYS', 'SAL', 'TNF', 'PAC', 'PRL', 'TKK', 'UL1', 'UDC',
-               'ADR', 'TYP', 'PIN', 'MAC', 'CAC', 'KHR', 'EC00', 'EC01',
-               'EC02', 'EC03', 'EC04', 'EC05', 'EC06', 'EC07', 'EC08',
-               'BDN', 'SWV', 'DIN', 'LAN', 'SDAT', 'FDAT', 'KLD', 'KLM',
-               'KLY']
-
 status_codes = {
     20000 : 'No Communication', 20001 : 'Running', 20002 : 'Irradiance too low', 20003 : 'Startup', 20004 : 'MPP operation', 20006 : 'Maximum power',
     20007 : 'Temperature limitation', 20008 : 'Mains operation', 20009 : 'Idc limitation', 20010 : 'Iac limitation',
@@ -85,14 +83,72 @@ alarm_codes = {
 }
 
 
+def describe_status(values):
+    # (status, alarms) text for the SYS and SAL values of an answer
+    errors = []
+    if values['SAL'] > 0:
+        for (code, descr) in alarm_codes.iteritems():
+            if code & values['SAL']:
+                errors.append(descr)
+
+    code = values['SYS'][0]
+    return (status_codes.get(code, 'Unknown status %s' % code), ', '.join(errors))
+
+
+# Consecutive queries without answer before an inverter is detected again
+MAX_QUERY_FAILURES = 3
+
+# Receive buffer size and the largest answer we accept before giving up on a frame
+RECEIVE_BUFFER_SIZE = 4096
+MAX_FRAME_SIZE = 4096
+
+
+# Splits the byte stream of a socket into complete {...} frames. Reads in large chunks
+# into a reusable buffer, bytes following a frame are kept for the next call.
+class FrameReader(object):
+    def __init__(self, sock, bufsize=RECEIVE_BUFFER_SIZE, max_frame=MAX_FRAME_SIZE):
+        self.__socket = sock
+        self.__buffer = bytearray(bufsize)
+        self.__view = memoryview(self.__buffer)
+        self.__pending = bytearray()
+        self.__max_frame = max_frame
+
+    def reset(self):
+        del self.__pending[:]
+
+    def read_frame(self):
+        while True:
+            end = self.__pending.find(b'}')
+            if end >= 0:
+                frame = bytes(self.__pending[:end + 1])
+                del self.__pending[:end + 1]
+                return frame
+            if len(self.__pending) > self.__max_frame:
+                self.reset()
+                raise ValueError('Frame exceeds %d bytes' % self.__max_frame)
+            received = self.__socket.recv_into(self.__buffer)
+            if received == 0:
+                # Connection closed by the gateway, hand out whatever is left
+                frame = bytes(self.__pending)
+                self.reset()
+                return frame
+            self.__pending += self.__view[:received]
+
+
 class SolarMax(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, discovery=None):
         self.__host = host
         self.__port = port
+        self.__discovery = discovery
+        self.__failures = {}
         self.__inverters = {}
         self.__socket = None
+        self.__reader = None
         self.__connected = False
         self.__allinverters = False
+        self.__detection_running = False
+        self.__connects = 0
+        self.__detections = 0
         self.__inverter_list = []
         self.__connect()
 
@@ -105,7 +161,7 @@ class SolarMax(object):
 
     def __disconnect(self):
         try:
-            log.info("Closing open connection to {}:{}".format(self.__host, self.__port))
+            log.info("Closing open connection to %s:%s", self.__host, self.__port)
             self.__socket.shutdown(socket.SHUT_RDWR)
             self.__socket.close()
             del self.__socket
@@ -115,6 +171,7 @@ class SolarMax(object):
             self.__connected = False
             self.__allinverters = False
             self.__socket = None
+            self.__reader = None
 
     def __del__(self):
         log.debug("Destructor called")
@@ -122,160 +179,197 @@ class SolarMax(object):
 
     def __connect(self):
         self.__disconnect()
-        log.info("Establishing connection to {}:{}...".format(self.__host, self.__port))
+        log.info("Establishing connection to %s:%s...", self.__host, self.__port)
+        self.__connects += 1
+        if self.__connects > 1:
+            metrics.reconnects.inc(self.__host)
+        start = time.time()
         try:
             # Python 2.6
             # Socket-timeout: 5 secs
             self.__socket = socket.create_connection((self.__host, self.__port), 5)
+            self.__reader = FrameReader(self.__socket)
             self.__connected = True
             log.info("Connected.")
         except:
-            log.info("Connection to {}:{} failed, maybe it is night?".format(self.__host, self.__port))
+            log.info("Connection to %s:%s failed, maybe it is night?", self.__host, self.__port)
             self.__connected = False
             self.__allinverters = False
+        finally:
+            metrics.connect_seconds.observe(time.time() - start, self.__host)
 
     # Utility functions
     def hexval(self, i):
-        return (hex(i)[2:]).upper()
+        return codec.hexval(i)
 
     def checksum(self, s):
-        total = 0
-        for c in s:
-            total += ord(c)
-        h = self.hexval(total)
-        while len(h) < 4:
-            h = '0' + h
-        return h
+        return codec.checksum(s)
 
     def __receive(self):
         try:
-            data = ''
-            tmp = ''
-            while True:
-                tmp = self.__socket.recv(1)
-                data += tmp
-                if len(tmp) < 1 or tmp == '}':
-                    break
-                tmp = ''
-            return data
+            answer = self.__reader.read_frame()
+            if not answer:
+                # Gateway closed the connection, reconnect on the next query
+                self.__connected = False
+            return answer
+        except socket.timeout:
+            metrics.timeouts.inc(self.__host)
+            return ""
         except:
+            self.__connected = False
             self.__allinverters = False
             return ""
 
-    def __parse(self, answer):
-        # convenience checks
-        if answer[0] != '{' or answer[-1] != '}':
-            raise ValueError('Malformed answer: %s' % answer)
-        raw_answer = answer
-        answer = answer[1:-1]
-        checksum = answer[-4:]
-        content = answer[:-4]
-        # checksum
-        if checksum != self.checksum(content):
-            raise ValueError('Checksum error')
-
-        (header, content) = content[:-1].split('|', 2)
-        (inverter, fb, length) = header.split(';', 3)
-        if fb != 'FB':
-            raise ValueError('Answer not understood')
-        # length
-        length = int(length, 16)
-        if length != len(raw_answer):
-            raise ValueError('Length mismatch')
-
-        inverter = int(inverter, 16)
-
-        # With write access to the WR responds with 'C8'
-        # if not content.startswith('64:'):
-        #  raise ValueError('Inverter did not understand our query')
-
-        content = content[3:]
-        data = {}
-
-        for item in content.split(';'):
-            (key, value) = item.split('=')
-            if key not in query_types:
-                raise NotImplementedError("Don't know %s" % item)
-            data[key] = value
-        return (inverter, data)
+    def __parse(self, answer, decode=False):
+        start = time.time()
+        try:
+            return codec.parse_answer(answer, decode)
+        except codec.ChecksumError:
+            metrics.checksum_errors.inc(self.__host)
+            raise
+        finally:
+            metrics.parse_seconds.observe(time.time() - start, self.__host)
 
     def connected(self):
         return self.__connected
 
+    def alive(self):
+        # Cheap health check of an idle connection: a readable socket without data was closed
+        # by the gateway, left over bytes are answers to earlier queries that timed out.
+        if not self.__connected:
+            return False
+        try:
+            while select.select([self.__socket], [], [], 0)[0]:
+                if not self.__socket.recv(RECEIVE_BUFFER_SIZE):
+                    self.__connected = False
+                    return False
+            self.__reader.reset()
+            return True
+        except (socket.error, select.error, ValueError):
+            self.__connected = False
+            return False
+
+    def reconnect(self):
+        self.__connect()
+
+    def close(self):
+        self.__disconnect()
+
     def host_ip(self):
         return self.__host
 
     def __build_query(self, id, values, qtype=100):
-        qtype = self.hexval(qtype)
-        if type(values) == list:
-            for v in values:
-                if v not in query_types:
-                    raise ValueError('Unknown data type »' + v + '«')
-            values = ';'.join(values)
-        elif type(values) in [str, unicode]:
-            pass
-        else:
-            raise ValueError('Value has unsupported type')
-
-        querystring = '|' + qtype + ':' + values + '|'
-        # Length enlarge: 2 x {(2), WR number (2), "FB" (2) two semicolon (2), length itself (2), checksum (4)
-        l = len(querystring) + 2 + 2 + 2 + 2 + 2 + 4
-        querystring = 'FB;%s;%s%s' % (self.hexval(id), self.hexval(l), querystring)
-        querystring += self.checksum(querystring)
-        return '{%s}' % querystring
+        return codec.build_query(id, values, qtype)
 
     def __send_query(self, querystring):
         try:
-            self.__socket.send(querystring)
+            self.__socket.sendall(querystring)
         except socket.timeout:
-            self.__allinverters = False
+            pass
         except socket.error:
             self.__connected = False
 
     def query(self, id, values, qtype=100):
+        if not self.__connected:
+            self.__connect()
+            if not self.__connected:
+                return None
         log.debug("Building query")
         q = self.__build_query(id, values, qtype)
-        log.debug("Sending query to host {} => {}".format(self.__host, q))
+        log.debug("Sending query to host %s => %s", self.__host, q)
+        start = time.time()
         self.__send_query(q)
-        answer = self.__receive()
-        log.debug("Answer: {}".format(answer))
-        if answer:
-            (inverter, data) = self.__parse(answer)
-            for d in data.keys():
-                data[d] = self.normalize_value(d, data[d])
+        while True:
+            answer = self.__receive()
+            log.debug("Answer: %s", answer)
+            if not answer:
+                break
+            try:
+                (inverter, data) = self.__parse(answer, decode=True)
+            except (ValueError, NotImplementedError) as e:
+                log.info("Dropping answer from %s: %s", self.__host, e)
+                continue
+            if inverter != id or not self.__answers(values, data):
+                # Late answer to an earlier query that timed out, ours is still to come
+                log.debug("Dropping answer from inverter #%s on %s with %s, waiting for #%s", inverter, self.__host,
+                          sorted(data.keys()), id)
+                continue
+            metrics.query_seconds.observe(time.time() - start, self.__host, id)
+            self.__failures[id] = 0
             return inverter, data
-        else:
-            self.__allinverters = False
 
-        if not self.__allinverters and not self.__detection_running:
+        # Whatever arrived of the late answer must not be taken for the next one
+        if self.__reader is not None:
+            self.__reader.reset()
+        if not self.__query_failed(id):
+            raise socket.timeout
+        return None
+
+    def query_many(self, ids, values, qtype=100):
+        # Pipelined variant of query(): the queries for all inverters are sent back to back
+        # and the answers are matched to them by the inverter address in the answer frame,
+        # so the order of the answers does not matter.
+        if not self.__connected:
+            self.__connect()
+            if not self.__connected:
+                return {}
+        queries = [self.__build_query(id, values, qtype) for id in ids]
+        log.debug("Sending %s queries to host %s => %s", len(queries), self.__host, queries)
+        start = time.time()
+        self.__send_query(''.join(queries))
+
+        results = {}
+        pending = set(ids)
+        while pending and self.__connected:
+            answer = self.__receive()
+            log.debug("Answer: %s", answer)
+            if not answer:
+                break
+            try:
+                (inverter, data) = self.__parse(answer, decode=True)
+            except (ValueError, NotImplementedError) as e:
+                log.info("Dropping answer from %s: %s", self.__host, e)
+                continue
+            if inverter not in pending or not self.__answers(values, data):
+                log.debug("Unexpected answer from inverter #%s on %s with %s", inverter, self.__host,
+                          sorted(data.keys()))
+                continue
+            metrics.query_seconds.observe(time.time() - start, self.__host, inverter)
+            self.__failures[inverter] = 0
+            pending.discard(inverter)
+            results[inverter] = data
+
+        for id in pending:
+            log.info("Inverter #%s on %s did not answer", id, self.__host)
+            self.__query_failed(id)
+        return results
+
+    def __answers(self, values, data):
+        # An answer to a query for a list of registers holds no other registers, one that does
+        # is the late answer to another query to the same inverter (like ADR;TYP;PIN)
+        if not isinstance(values, (list, tuple)):
+            return True
+        return set(data.keys()).issubset(values)
+
+    def __query_failed(self, id):
+        # A single missing answer is not a reason to detect all inverters again,
+        # only repeated failures of the same inverter are.
+        self.__failures[id] = self.__failures.get(id, 0) + 1
+        if self.__failures[id] >= MAX_QUERY_FAILURES and not self.__detection_running:
+            log.info("Inverter #%s on %s did not answer %s times, detecting inverters again",
+                     id, self.__host, self.__failures[id])
+            self.__failures[id] = 0
+            if self.__discovery is not None:
+                self.__discovery.invalidate(self.__host, id)
             self.detect_inverters()
         elif not self.__connected:
             self.__connect()
         else:
-            raise socket.timeout
-        return None
+            return False
+        return True
 
     def normalize_value(self, key, value):
-        if key in ['KDY', 'UL1', 'UDC']:
-            return float(int(value, 16)) / 10
-        elif key in ['IL1', 'IDC', 'TNF', ]:
-            return float(int(value, 16)) / 100
-        elif key in ['PAC', 'PIN', ]:
-            return float(int(value, 16)) / 2
-        elif key in ['SAL', ]:
-            return int(value, 16)
-        elif key in ['SYS', ]:
-            (x, y) = value.split(',', 2)
-            x = int(x, 16)
-            y = int(y, 16)
-            return (x, y)
-        elif key in ['SDAT', 'FDAT']:
-            (date, time) = value.split(',', 2)
-            time = int(time, 16)
-            return datetime.datetime(int(date[:3], 16), int(date[3:5], 16), int(date[5:], 16), time / 3600,
-                                     (time % 3600) / 60, time % (3600 * 60))
-        else:
-            return int(value, 16)
+        return codec.normalize_value(key, value)
 
     def write_setting(self, inverter, data):
         rawdata = []
@@ -291,20 +385,18 @@ class SolarMax(object):
         result = self.query(inverter, ['SYS', 'SAL'])
         if not result:
             return ('Offline', 'Offline')
-        result = result[1]
-        errors = []
-        if result['SAL'] > 0:
-            for (code, descr) in alarm_codes.iteritems():
-                if code & result['SAL']:
-                    errors.append(descr)
+        return describe_status(result[1])
 
-        status = status_codes[result['SYS'][0]]
-        return (status, ', '.join(errors))
+    def inverter_list(self):
+        # The configured device ids, detected or not
+        return self.__inverter_list
 
-    def use_inverters(self, list_of):
+    def use_inverters(self, list_of, detect=True):
         self.__inverter_list = list_of
-        log.debug("Inverters to detect: {}".format(list_of))
-        self.detect_inverters()
+        self.__allinverters = False
+        log.debug("Inverters to detect: %s", list_of)
+        if detect:
+            self.detect_inverters()
 
     def detect_inverters(self):
         self.__inverters = {}
@@ -312,25 +404,37 @@ class SolarMax(object):
             self.__connect()
 
         if self.__connected:
+            self.__detections += 1
+            if self.__detections > 1:
+                metrics.redetections.inc(self.__host)
             self.__detection_running = True
             for inverter in self.__inverter_list:
+                known = self.__discovery.get(self.__host, inverter) if self.__discovery is not None else None
+                if known is not None and known['type'] in inverter_types:
+                    self.__inverters[inverter] = inverter_types[known['type']].copy()
+                    self.__inverters[inverter]['power_installed'] = known['power_installed']
+                    continue
                 try:
-                    log.debug("Searching for #{} (socket: {})".format(inverter, self.__socket))
+                    log.debug("Searching for #%s (socket: %s)", inverter, self.__socket)
                     (inverter, data) = self.query(inverter, ['ADR', 'TYP', 'PIN'])
                     if data['TYP'] in inverter_types.keys():
                         self.__inverters[inverter] = inverter_types[data['TYP']].copy()
                         self.__inverters[inverter]['power_installed'] = data['PIN']
+                        if self.__discovery is not None:
+                            self.__discovery.put(self.__host, inverter, data['TYP'], data['PIN'])
                     else:
-                        log.debug("Unknown inverter type: {} (ID #{})".format(data['TYP'], data['ADR']))
+                        log.debug("Unknown inverter type: %s (ID #%s)", data['TYP'], data['ADR'])
+                        if self.__discovery is not None:
+                            self.__discovery.invalidate(self.__host, inverter)
                 except Exception as e:
-                    log.debug("Inverter #{} not found: {}".format(inverter, e))
+                    log.debug("Inverter #%s not found: %s", inverter, e)
                     self.__allinverters = False
             self.__detection_running = False
             if len(self.__inverters) == len(self.__inverter_list):
                 self.__allinverters = True
                 log.info("Found all inverters:")
                 for inverter in self.__inverters.keys():
-                    log.info("#{}: {}".format(inverter, self.__inverters[inverter]))
+                    log.info("#%s: %s", inverter, self.__inverters[inverter])
             else:
                 log.info("Not all inverters found, reconnecting!")
                 self.__connect()
@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+import logging
+
+log = logging.getLogger("solarmax")
+
+SEGMENT_SUFFIX = '.seg'
+
+# InfluxDB status codes that mean the points themselves cannot be written, everything else
+# (bad credentials, missing database, outages) is retried
+REJECTED = (400,)
+
+
+# Append-only on-disk spool of line protocol points, split into numbered segment files.
+# Points are appended to the current segment; sealed segments are handed to the
+# drainer in order and removed once the database acknowledged them.
+class Spool(object):
+    def __init__(self, directory, segment_bytes=1024 * 1024, max_bytes=100 * 1024 * 1024, flush_interval=0):
+        self.__directory = directory
+        self.__segment_bytes = segment_bytes
+        self.__max_bytes = max_bytes
+        self.__flush_interval = flush_interval
+        self.__lock = threading.Lock()
+        self.__sealed = threading.Condition(self.__lock)
+        self.__last_seal = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Segments left over from a previous run (including the one that was open) are sent first
+        self.__segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                 if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        if self.__segments:
+            log.info("Spool %s holds %s segments from a previous run", directory, len(self.__segments))
+        self.__current = None
+        self.__current_size = 0
+        self.__open_segment(self.__segments[-1] + 1 if self.__segments else 0)
+
+    def __repr__(self):
+        return 'Spool[%s / segments=%s]' % (self.__directory, len(self.__segments))
+
+    def __path(self, number):
+        return os.path.join(self.__directory, '%012d%s' % (number, SEGMENT_SUFFIX))
+
+    def __open_segment(self, number):
+        self.__current_number = number
+        self.__current = open(self.__path(number), 'ab')
+        self.__current_size = 0
+
+    def __seal(self):
+        # Called with the lock held
+        self.__last_seal = time.time()
+        if not self.__current_size:
+            return
+        self.__current.close()
+        self.__segments.append(self.__current_number)
+        self.__open_segment(self.__current_number + 1)
+        self.__enforce_limit()
+        self.__sealed.notify_all()
+
+    def __enforce_limit(self):
+        total = self.__current_size
+        sizes = []
+        for number in self.__segments:
+            try:
+                size = os.path.getsize(self.__path(number))
+            except OSError:
+                size = 0
+            sizes.append(size)
+            total += size
+
+        dropped = 0
+        while self.__segments and total > self.__max_bytes:
+            number = self.__segments.pop(0)
+            total -= sizes.pop(0)
+            self.__unlink(number)
+            dropped += 1
+        if dropped:
+            log.warning("Spool exceeds %s bytes, dropped %s oldest segments", self.__max_bytes, dropped)
+
+    def __unlink(self, number):
+        try:
+            os.remove(self.__path(number))
+        except OSError:
+            pass
+
+    def add(self, lines):
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        with self.__lock:
+            self.__current.write(data)
+            self.__current.flush()
+            self.__current_size += len(data)
+            if self.__current_size >= self.__segment_bytes:
+                self.__seal()
+
+    def flush_due(self):
+        with self.__lock:
+            if time.time() - self.__last_seal >= self.__flush_interval:
+                self.__seal()
+
+    def flush(self):
+        with self.__lock:
+            self.__seal()
+
+    def wait_segments(self, timeout):
+        # Numbers of the sealed segments, oldest first
+        with self.__lock:
+            if not self.__segments:
+                self.__sealed.wait(timeout)
+            return list(self.__segments)
+
+    def read(self, number):
+        try:
+            with open(self.__path(number), 'rb') as f:
+                data = f.read().decode('utf-8')
+        except (IOError, OSError):
+            return []
+        lines = data.split('\n')
+        # A segment cut short by a crash may end with half a line, which is left out
+        return [line for line in lines[:-1] if line]
+
+    def remove(self, number):
+        with self.__lock:
+            if number in self.__segments:
+                self.__segments.remove(number)
+            self.__unlink(number)
+
+    def close(self):
+        with self.__lock:
+            self.__seal()
+            self.__current.close()
+            # Wakes up a drainer waiting for segments
+            self.__sealed.notify_all()
+
+
+# Replays sealed spool segments to the database in order, in large batches, and
+# backs off while the database is not reachable. Small segments (one per run without a
+# flush_interval) are combined until a batch is full.
+class SpoolDrainer(threading.Thread):
+    def __init__(self, spool, writer, batch_size=5000, max_backoff=300):
+        threading.Thread.__init__(self, name="SpoolDrainer")
+        self.setDaemon(True)
+        self.__spool = spool
+        self.__writer = writer
+        self.__batch_size = batch_size
+        self.__max_backoff = max_backoff
+        self.__running = True
+
+    def stop(self):
+        self.__running = False
+
+    def run(self):
+        backoff = 1
+        while self.__running:
+            numbers = self.__spool.wait_segments(10)
+            if not numbers:
+                continue
+
+            (numbers, lines) = self.__collect(numbers)
+            if self.__send(numbers, lines):
+                for number in numbers:
+                    self.__spool.remove(number)
+                backoff = 1
+            else:
+                log.info("Database not available, retrying spool segments %s-%s in %s seconds", numbers[0],
+                         numbers[-1], backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.__max_backoff)
+
+    def __collect(self, numbers):
+        # The oldest segments that fit into one batch together, at least one segment
+        taken = []
+        lines = []
+        for number in numbers:
+            segment = self.__spool.read(number)
+            if taken and len(lines) + len(segment) > self.__batch_size:
+                break
+            taken.append(number)
+            lines.extend(segment)
+        return (taken, lines)
+
+    def __send(self, numbers, lines):
+        # Segments are only removed after all of their batches were accepted. After a failure
+        # they are sent again, which InfluxDB treats as overwriting the same points.
+        for start in range(0, len(lines), self.__batch_size):
+            batch = lines[start:start + self.__batch_size]
+            try:
+                response = self.__writer.write(batch)
+            except Exception as e:
+                if getattr(e, 'code', None) in REJECTED:
+                    # Only this batch, the batches after it are still sent
+                    log.error("Database rejected %s points of spool segments %s-%s, dropping them: %s",
+                              len(batch), numbers[0], numbers[-1], e)
+                    continue
+                log.debug("Exception happened sending spool segments %s-%s to database: %s", numbers[0],
+                          numbers[-1], e)
+                return False
+            if response is not True:
+                return False
+        log.debug("Spool segments %s-%s with %s points sent to database", numbers[0], numbers[-1], len(lines))
+        return True
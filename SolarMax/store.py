@@ -0,0 +1,253 @@
+import os
+import time
+import mmap
+import array
+import threading
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger("solarmax")
+
+# Rollup resolutions, name -> bucket length in seconds
+resolutions = (('1m', 60), ('15m', 900), ('1d', 86400))
+resolution_seconds = dict(resolutions)
+
+# Every file is a flat column of doubles: raw files hold (timestamp, value) pairs,
+# rollup files (bucket start, min, max, mean, delta, count) records.
+RAW_WIDTH = 2
+ROLLUP_WIDTH = 6
+ITEM_SIZE = array.array('d').itemsize
+
+# Files kept open for appending, least recently used ones are closed beyond this. With
+# hundreds of gateways there are far more series than the usual limit of 1024 descriptors.
+MAX_OPEN_FILES = 256
+
+
+def _from_bytes(data, raw):
+    if hasattr(data, 'frombytes'):
+        data.frombytes(raw)
+    else:
+        data.fromstring(raw)
+    return data
+
+
+def _to_bytes(data):
+    return data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+
+
+class Bucket(object):
+    __slots__ = ('start', 'minimum', 'maximum', 'total', 'count', 'last', 'increase')
+
+    def __init__(self, start, value, previous=None):
+        # previous is the last value of the bucket before, the step from it belongs to this one
+        self.start = start
+        self.minimum = self.maximum = self.total = self.last = value
+        self.count = 1
+        self.increase = 0.0
+        if previous is not None and value > previous:
+            self.increase = value - previous
+
+    def add(self, value):
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.total += value
+        self.count += 1
+        if value > self.last:
+            self.increase += value - self.last
+        self.last = value
+
+    def record(self):
+        # The delta is what counters like KDY or KT0 gained within the bucket: the sum of the
+        # steps up, so a counter that starts over (KDY at local midnight) does not count negative
+        return [self.start, self.minimum, self.maximum, self.total / self.count, self.increase,
+                float(self.count)]
+
+
+# Embedded time-series store: one directory per (UTC) day, one fixed-width column file per
+# (host, inverter, register) and resolution. Rollups are built incrementally while appending
+# and written when their bucket is complete.
+class TimeSeriesStore(object):
+    def __init__(self, directory, max_open_files=MAX_OPEN_FILES):
+        self.__directory = directory
+        self.__lock = threading.Lock()
+        self.__files = OrderedDict()
+        self.__max_open_files = max_open_files
+        self.__day = None
+        self.__buckets = {}
+        self.__restored = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__restore()
+
+    def __repr__(self):
+        return 'TimeSeriesStore[%s / series=%s]' % (self.__directory, len(self.__buckets) // len(resolutions))
+
+    def __series(self, host, inverter, register):
+        return '%s_%s_%s' % (host, inverter, register)
+
+    def __day_of(self, timestamp):
+        return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+    def __path(self, day, series, resolution):
+        return os.path.join(self.__directory, day, '%s.%s' % (series, resolution))
+
+    def __append(self, path, values):
+        f = self.__files.pop(path, None)
+        if f is None:
+            if len(self.__files) >= self.__max_open_files:
+                self.__files.popitem(last=False)[1].close()
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(path, 'ab')
+        self.__files[path] = f
+        f.write(_to_bytes(array.array('d', values)))
+
+    def __close_files(self):
+        for f in self.__files.values():
+            f.close()
+        self.__files = OrderedDict()
+
+    def append(self, host, inverter, timestamp, values):
+        # timestamp in milliseconds, values as returned by SolarMax.query
+        timestamp = timestamp / 1000.0
+        day = self.__day_of(timestamp)
+        with self.__lock:
+            if day != self.__day:
+                # Only the files of the current day are kept open
+                self.__close_files()
+                self.__day = day
+            for (register, value) in values.items():
+                if isinstance(value, tuple):
+                    value = value[0]
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                series = self.__series(host, inverter, register)
+                self.__append(self.__path(day, series, 'raw'), [timestamp, value])
+                self.__roll(series, timestamp, value)
+            for f in self.__files.values():
+                f.flush()
+
+    def __roll(self, series, timestamp, value):
+        for (name, seconds) in resolutions:
+            start = timestamp - timestamp % seconds
+            key = (series, name)
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                self.__buckets[key] = Bucket(start, value)
+            elif bucket.start != start:
+                self.__write_bucket(series, name, bucket)
+                self.__buckets[key] = Bucket(start, value, bucket.last)
+            else:
+                bucket.add(value)
+
+    def __write_bucket(self, series, name, bucket):
+        path = self.__path(self.__day_of(bucket.start), series, name)
+        if (series, name) in self.__restored:
+            self.__restored.discard((series, name))
+            self.__drop_record(path, bucket.start)
+        if self.__day_of(bucket.start) == self.__day:
+            self.__append(path, bucket.record())
+        else:
+            # Bucket of an earlier day, do not keep its file open
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path, 'ab') as f:
+                f.write(_to_bytes(array.array('d', bucket.record())))
+
+    def __restore(self):
+        # The buckets that were open when the logger stopped are rebuilt from the raw samples
+        # of the last day, so a restart continues them instead of starting a second record
+        # with the same start. A record close() wrote for them is replaced when they are written.
+        days = sorted(name for name in os.listdir(self.__directory)
+                      if os.path.isdir(os.path.join(self.__directory, name)))
+        if not days:
+            return
+        day = days[-1]
+        for name in os.listdir(os.path.join(self.__directory, day)):
+            if not name.endswith('.raw'):
+                continue
+            series = name[:-len('.raw')]
+            data = self.__read(self.__path(day, series, 'raw'), RAW_WIDTH)
+            if not data:
+                continue
+            last = data[-RAW_WIDTH]
+            for (resolution, seconds) in resolutions:
+                start = last - last % seconds
+                first = len(data) - RAW_WIDTH
+                while first >= RAW_WIDTH and data[first - RAW_WIDTH] >= start:
+                    first -= RAW_WIDTH
+                bucket = Bucket(start, data[first + 1], data[first - 1] if first else None)
+                for i in range(first + RAW_WIDTH, len(data), RAW_WIDTH):
+                    bucket.add(data[i + 1])
+                self.__buckets[(series, resolution)] = bucket
+                self.__restored.add((series, resolution))
+        if self.__buckets:
+            log.info("Store %s continues %s open buckets of %s", self.__directory, len(self.__buckets), day)
+
+    def __drop_record(self, path, start):
+        data = self.__read(path, ROLLUP_WIDTH)
+        if data and data[-ROLLUP_WIDTH] == start:
+            with open(path, 'r+b') as f:
+                f.truncate((len(data) - ROLLUP_WIDTH) * ITEM_SIZE)
+
+    def close(self):
+        # Write the buckets that are still open, their rollups would be lost otherwise
+        with self.__lock:
+            for ((series, name), bucket) in self.__buckets.items():
+                self.__write_bucket(series, name, bucket)
+            self.__buckets = {}
+            self.__close_files()
+
+    def __read(self, path, width):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return array.array('d')
+        size -= size % (ITEM_SIZE * width)
+        if not size:
+            return array.array('d')
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return _from_bytes(array.array('d'), mapped[:size])
+            finally:
+                mapped.close()
+
+    def query(self, host, inverter, register, start, end, resolution='raw'):
+        # Samples (timestamp, value) with start <= timestamp < end, or the rollups
+        # (start, min, max, mean, delta, count) of the buckets overlapping that range.
+        # Timestamps in seconds.
+        if resolution == 'raw':
+            width = RAW_WIDTH
+        elif resolution in resolution_seconds:
+            width = ROLLUP_WIDTH
+            start -= start % resolution_seconds[resolution]
+        else:
+            raise ValueError('Unknown resolution %s' % resolution)
+        series = self.__series(host, inverter, register)
+        with self.__lock:
+            for f in self.__files.values():
+                f.flush()
+
+        result = []
+        day = start - start % 86400
+        while day < end:
+            data = self.__read(self.__path(self.__day_of(day), series, resolution), width)
+            for i in range(0, len(data), width):
+                if start <= data[i] < end:
+                    result.append(tuple(data[i:i + width]))
+            day += 86400
+
+        if resolution != 'raw':
+            # Include the bucket that is still being filled
+            bucket = self.__buckets.get((series, resolution))
+            if bucket is not None and start <= bucket.start < end:
+                result = [record for record in result if record[0] != bucket.start]
+                result.append(tuple(bucket.record()))
+        return result
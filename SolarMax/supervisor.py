@@ -0,0 +1,113 @@
+import os
+import sys
+import zlib
+import time
+import logging
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+log = logging.getLogger("solarmax")
+
+
+def shard_of(host, workers):
+    # crc32 is stable across processes and restarts, unlike hash()
+    return (zlib.crc32(host.encode('utf-8')) & 0xffffffff) % workers
+
+
+def shard_hosts(inverters, workers):
+    shards = [dict() for i in range(workers)]
+    for (host, devices) in inverters.items():
+        shards[shard_of(host, workers)][host] = devices
+    return shards
+
+
+# Runs one worker process per shard of gateways, restarts workers that died and
+# combines the statistics every worker reports after each run.
+class Supervisor(object):
+    def __init__(self, inverters, workers, target, args=(), reload=None):
+        # multiprocessing is only imported when there is more than one worker
+        import multiprocessing
+        self.__shards = shard_hosts(inverters, workers)
+        self.__target = target
+        self.__args = args
+        self.__reload = reload
+        self.stats = multiprocessing.Queue()
+        self.__processes = [None] * workers
+        self.__runs = {}
+
+    def __repr__(self):
+        return 'Supervisor[workers=%s / hosts=%s]' % (len(self.__shards), [len(s) for s in self.__shards])
+
+    def __start(self, index):
+        import multiprocessing
+        process = multiprocessing.Process(name="worker-%d" % index, target=self.__target,
+                                          args=(index, self.__shards[index], self.stats) + tuple(self.__args))
+        process.daemon = True
+        process.start()
+        self.__processes[index] = process
+        log.info("Started worker %s (pid %s) for %s gateways", index, process.pid, len(self.__shards[index]))
+
+    def run(self):
+        # Workers without gateways are started as well, gateways added to the configuration
+        # later on are picked up by the worker of their shard
+        for index in range(len(self.__shards)):
+            self.__start(index)
+
+        while True:
+            for (index, process) in enumerate(self.__processes):
+                if process is not None and not process.is_alive():
+                    log.warning("Worker %s (pid %s) exited with code %s, restarting it", index, process.pid,
+                                process.exitcode)
+                    self.__refresh()
+                    self.__start(index)
+            try:
+                self.__collect(self.stats.get(timeout=5))
+            except queue.Empty:
+                pass
+
+    def __refresh(self):
+        # reload returns (inverters, args) as they are now, a restarted worker must not go
+        # back to the configuration the supervisor was started with
+        if self.__reload is None:
+            return
+        try:
+            (inverters, args) = self.__reload()
+        except Exception as e:
+            log.error("Restarting with the previous configuration: %s", e)
+            return
+        self.__shards = shard_hosts(inverters, len(self.__processes))
+        self.__args = args
+
+    def signal(self, signum, frame=None):
+        for process in self.__processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop(self, signum, frame=None):
+        # The workers write what they still hold in memory, their log records keep coming in meanwhile
+        self.signal(signum)
+        for process in self.__processes:
+            if process is not None:
+                process.join(30)
+        sys.exit(0)
+
+    def __collect(self, stats):
+        # Runs of all workers at the same aligned timestamp are combined into one line
+        timestamp = stats['timestamp']
+        run = self.__runs.setdefault(timestamp, {'workers': 0, 'inverters': 0, 'expected': 0, 'duration': 0.0})
+        run['workers'] += 1
+        run['inverters'] += stats['inverters']
+        run['expected'] += stats['expected']
+        run['duration'] = max(run['duration'], stats['duration'])
+
+        running = len([p for p in self.__processes if p is not None])
+        for timestamp in sorted(self.__runs.keys()):
+            run = self.__runs[timestamp]
+            if run['workers'] < running and timestamp == stats['timestamp']:
+                continue
+            del self.__runs[timestamp]
+            log.info("Run %s: %s of %s inverters queried by %s workers, slowest worker took %.2f seconds",
+                     timestamp, run['inverters'], run['expected'], run['workers'], run['duration'])
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# Micro-benchmark of building query frames and parsing answers, comparing the
+# string based implementation SolarMax used before with SolarMax.codec.
+#
+#   python benchmarks/bench_codec.py [rounds]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SolarMax import codec
+from SolarMax.codec import query_types
+
+REGISTERS = ['PAC', 'UL1', 'TKK', 'KDY', 'KMT', 'KYR', 'KT0']
+CONTENT = '|64:PAC=1F4;UL1=8FC;TKK=2A;KDY=5A;KMT=3E8;KYR=1388;KT0=2710|'
+
+
+def legacy_hexval(i):
+    return (hex(i)[2:]).upper()
+
+
+def legacy_checksum(s):
+    total = 0
+    for c in s:
+        total += ord(c)
+    h = legacy_hexval(total)
+    while len(h) < 4:
+        h = '0' + h
+    return h
+
+
+def legacy_build_query(id, values, qtype=100):
+    qtype = legacy_hexval(qtype)
+    for v in values:
+        if v not in query_types:
+            raise ValueError('Unknown data type ' + v)
+    values = ';'.join(values)
+    querystring = '|' + qtype + ':' + values + '|'
+    l = len(querystring) + 2 + 2 + 2 + 2 + 2 + 4
+    querystring = 'FB;%s;%s%s' % (legacy_hexval(id), legacy_hexval(l), querystring)
+    querystring += legacy_checksum(querystring)
+    return '{%s}' % querystring
+
+
+def legacy_normalize_value(key, value):
+    if key in ['KDY', 'UL1', 'UDC']:
+        return float(int(value, 16)) / 10
+    elif key in ['IL1', 'IDC', 'TNF', ]:
+        return float(int(value, 16)) / 100
+    elif key in ['PAC', 'PIN', ]:
+        return float(int(value, 16)) / 2
+    elif key in ['SAL', ]:
+        return int(value, 16)
+    elif key in ['SYS', ]:
+        (x, y) = value.split(',', 2)
+        return (int(x, 16), int(y, 16))
+    else:
+        return int(value, 16)
+
+
+def legacy_parse(answer):
+    if answer[0] != '{' or answer[-1] != '}':
+        raise ValueError('Malformed answer: %s' % answer)
+    raw_answer = answer
+    answer = answer[1:-1]
+    checksum = answer[-4:]
+    content = answer[:-4]
+    if checksum != legacy_checksum(content):
+        raise ValueError('Checksum error')
+    (header, content) = content[:-1].split('|', 2)
+    (inverter, fb, length) = header.split(';', 3)
+    if fb != 'FB':
+        raise ValueError('Answer not understood')
+    if int(length, 16) != len(raw_answer):
+        raise ValueError('Length mismatch')
+    data = {}
+    for item in content[3:].split(';'):
+        (key, value) = item.split('=')
+        if key not in query_types:
+            raise NotImplementedError("Don't know %s" % item)
+        data[key] = legacy_normalize_value(key, value)
+    return (int(inverter, 16), data)
+
+
+def codec_parse(answer):
+    return codec.parse_answer(answer, decode=True)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frame = '01;FB;%02X%s' % (len(CONTENT) + 14, CONTENT)
+    answer = '{%s%s}' % (frame, legacy_checksum(frame))
+    assert legacy_build_query(3, REGISTERS) == codec.build_query(3, REGISTERS)
+    assert legacy_parse(answer) == codec_parse(answer)
+
+    print("{:<10} {:>14} {:>14} {:>8}".format("operation", "legacy ops/s", "codec ops/s", "speedup"))
+    for (name, legacy, new) in [
+            ("encode", lambda: legacy_build_query(3, REGISTERS), lambda: codec.build_query(3, REGISTERS)),
+            ("decode", lambda: legacy_parse(answer), lambda: codec_parse(answer))]:
+        legacy_rate = rounds / min(timeit.repeat(legacy, number=rounds, repeat=3))
+        new_rate = rounds / min(timeit.repeat(new, number=rounds, repeat=3))
+        print("{:<10} {:>14.0f} {:>14.0f} {:>7.1f}x".format(name, legacy_rate, new_rate, new_rate / legacy_rate))
+
+
+if __name__ == '__main__':
+    main()
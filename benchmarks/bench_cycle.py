@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# End-to-end load benchmark: runs solarmax_logger() against simulated gateways and
+# reports cycle time, answered queries per second, CPU time and memory of the logger
+# as the number of gateways and devices per gateway grows. The simulator runs in its
+# own process so its CPU time is not counted.
+#
+#   python benchmarks/bench_cycle.py --gateways 1,10,50 --devices 1,4,16 --latency 0.02
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SolarMax.simulator import Simulator, loopback_hosts
+from SolarMax.pool import SessionPool
+import solarmax_logger
+
+REGISTERS = ['PAC', 'UL1', 'TKK', 'KDY', 'KMT', 'KYR', 'KT0']
+
+
+class CountingSink(object):
+    def __init__(self):
+        self.points = 0
+
+    def add(self, lines):
+        self.points += len(lines)
+
+    def flush_due(self):
+        pass
+
+
+def run_simulator(hosts, port, devices, options, ready):
+    Simulator(hosts, port, devices, **options).start()
+    ready.set()
+    while True:
+        time.sleep(60)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench(gateways, devices, cycles, port, options, pipeline):
+    hosts = loopback_hosts(gateways)
+    ready = multiprocessing.Event()
+    simulator = multiprocessing.Process(target=run_simulator,
+                                        args=[hosts, port, list(range(1, devices + 1)), options, ready])
+    simulator.daemon = True
+    simulator.start()
+    ready.wait(10)
+
+    try:
+        pool = SessionPool(port)
+        inverters = dict((host, list(range(1, devices + 1))) for host in hosts)
+        sink = CountingSink()
+
+        # The first run connects and detects the inverters, it is not measured
+        solarmax_logger.solarmax_logger(pool, inverters, sink, 'bench', REGISTERS, pipeline=pipeline)
+        sink.points = 0
+
+        durations = []
+        cpu = cpu_seconds()
+        for cycle in range(cycles):
+            start = time.time()
+            solarmax_logger.solarmax_logger(pool, inverters, sink, 'bench', REGISTERS, pipeline=pipeline)
+            durations.append(time.time() - start)
+        cpu = cpu_seconds() - cpu
+        pool.close()
+    finally:
+        simulator.terminate()
+        simulator.join()
+
+    queries = sink.points / len(REGISTERS)
+    return {
+        'cycle_mean': sum(durations) / len(durations),
+        'cycle_max': max(durations),
+        'queries_per_second': queries / sum(durations),
+        'cpu_per_cycle': cpu / cycles,
+        'answered': float(queries) / (cycles * gateways * devices),
+        'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+@click.command()
+@click.option("--gateways", default="1,10,50", help="Comma separated numbers of gateways")
+@click.option("--devices", default="1,4,16", help="Comma separated numbers of devices per gateway")
+@click.option("--cycles", default=5, help="Measured cycles per combination")
+@click.option("--port", default=12345, help="TCP port of the simulated gateways")
+@click.option("--latency", default=0.02, help="Seconds before every answer")
+@click.option("--jitter", default=0.0, help="Random extra seconds before every answer")
+@click.option("--drop-rate", default=0.0, help="Fraction of queries that get no answer")
+@click.option("--corrupt-rate", default=0.0, help="Fraction of answers with a flipped bit")
+@click.option("--pipeline/--no-pipeline", default=False, help="Use pipelined queries")
+def main(gateways, devices, cycles, port, latency, jitter, drop_rate, corrupt_rate, pipeline):
+    options = {'latency': latency, 'jitter': jitter, 'drop_rate': drop_rate, 'corrupt_rate': corrupt_rate}
+    print("{:>8} {:>8} {:>12} {:>12} {:>10} {:>12} {:>9} {:>10}".format(
+        "gateways", "devices", "cycle mean", "cycle max", "queries/s", "cpu/cycle", "answered", "maxrss MB"))
+    for g in [int(n) for n in gateways.split(',')]:
+        for d in [int(n) for n in devices.split(',')]:
+            result = bench(g, d, cycles, port, options, pipeline)
+            print("{:>8} {:>8} {:>11.3f}s {:>11.3f}s {:>10.1f} {:>11.4f}s {:>8.0%} {:>10.1f}".format(
+                g, d, result['cycle_mean'], result['cycle_max'], result['queries_per_second'],
+                result['cpu_per_cycle'], result['answered'], result['maxrss_mb']))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
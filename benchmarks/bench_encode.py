@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# Micro-benchmark of turning the answers of one run into line protocol, comparing the
+# per-inverter dicts and format strings used before with Sample and LineEncoder.
+#
+#   python benchmarks/bench_encode.py [inverters] [rounds]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SolarMax.sample import Sample, LineEncoder
+
+REGISTERS = ('PAC', 'UDC', 'IDC', 'UL1', 'TKK', 'KDY', 'KMT', 'KYR', 'KT0', 'SYS')
+ANSWER = {'PAC': 2150.5, 'UDC': 612.3, 'IDC': 3.61, 'UL1': 231.4, 'TKK': 41, 'KDY': 12.3, 'KMT': 310,
+          'KYR': 4120, 'KT0': 51230, 'SYS': (20004, 0)}
+TIMESTAMP = 1760000000000
+
+NAMES = {
+    'PAC': ('power_generation', 'watt'), 'UL1': ('voltage', 'ac_volt'),
+    'TKK': ('inverter_temperature', 'celsius'), 'KDY': ('energy_generation_today', 'kwh'),
+    'KMT': ('energy_generation_this_month', 'kwh'), 'KYR': ('energy_generation_this_year', 'kwh'),
+    'KT0': ('energy_generation_total', 'kwh'), 'UDC': ('dc_voltage', 'dc_volt'), 'IDC': ('dc_current', 'ampere'),
+    'SYS': ('system_status', 'code'),
+}
+
+
+def legacy_line_protocol(measurement, host_ip, inverter, location, value_name, value, timestamp):
+    return ("{measurement},host_ip={host_ip},inverter={inverter},location={location} "
+            "{value_name}={value} {timestamp}".format(measurement=measurement, host_ip=host_ip, inverter=inverter,
+                                                      location=location, value_name=value_name, value=value,
+                                                      timestamp=timestamp))
+
+
+def legacy_encode(samples):
+    lines = []
+    for (host_ip, inverter, current, timestamp) in samples:
+        measurements = dict()
+        for (register, value) in current.items():
+            (measurement, value_name) = NAMES.get(register, (register.lower(), 'value'))
+            if register == 'SYS':
+                value = value[0]
+            measurements[measurement] = [value_name, float(value)]
+        for measurement in measurements.keys():
+            lines.append(legacy_line_protocol(measurement, host_ip, inverter, 'bench',
+                                              measurements[measurement][0], measurements[measurement][1],
+                                              timestamp))
+    return lines
+
+
+def main():
+    inverters = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    hosts = ['10.0.%d.%d' % (i // 250, i % 250 + 1) for i in range(inverters)]
+    encoder = LineEncoder('bench', NAMES)
+
+    def legacy():
+        samples = [(host, 1, dict(ANSWER), TIMESTAMP) for host in hosts]
+        return legacy_encode(samples)
+
+    def records():
+        samples = [Sample.from_answer(host, 1, TIMESTAMP, REGISTERS, ANSWER) for host in hosts]
+        encoder.clear()
+        for sample in samples:
+            encoder.encode(sample)
+        return encoder.buffer
+
+    assert sorted(legacy()) == sorted(records())
+    legacy_rate = rounds * inverters / min(timeit.repeat(legacy, number=rounds, repeat=3))
+    new_rate = rounds * inverters / min(timeit.repeat(records, number=rounds, repeat=3))
+    print("{:>12} {:>18} {:>18} {:>8}".format("inverters", "legacy samples/s", "record samples/s", "speedup"))
+    print("{:>12} {:>18.0f} {:>18.0f} {:>7.1f}x".format(inverters, legacy_rate, new_rate, new_rate / legacy_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# Startup benchmark: how long a fresh interpreter takes to import solarmax_logger and
+# how many modules that loads, and the time from starting the logger process until
+# the first sample of a simulated gateway is in the spool.
+#
+#   python benchmarks/bench_startup.py [rounds]
+
+import os
+import sys
+import time
+import glob
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from SolarMax.simulator import Simulator
+
+HOST = '127.0.1.250'
+
+IMPORT = """
+import sys, time
+start = time.time()
+sys.path.insert(0, %r)
+%s
+print('%%f %%d' %% (time.time() - start, len(sys.modules)))
+"""
+
+CONFIG = """
+[default]
+logdir = {directory}/log
+loglevel = WARNING
+discovery_file =
+[inverters]
+{host} = 1
+[registers]
+power = 1: PAC
+[influxdb]
+influxdb_host = 127.0.0.1
+influxdb_port = 9
+database = bench
+user =
+password =
+location = bench
+client = http
+[spool]
+directory = {directory}/spool
+[metrics]
+port = 0
+"""
+
+
+def import_time(statement, rounds):
+    results = []
+    for i in range(rounds):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT % (ROOT, statement)])
+        (seconds, modules) = output.split()
+        results.append((float(seconds), int(modules)))
+    return min(results)
+
+
+def run_simulator(ready):
+    Simulator([HOST], 12345, [1]).start()
+    ready.set()
+    while True:
+        time.sleep(60)
+
+
+def first_sample(directory, timeout=30):
+    path = os.path.join(directory, 'solarmax_logger.conf')
+    with open(path, 'w') as f:
+        f.write(CONFIG.format(directory=directory, host=HOST))
+
+    start = time.time()
+    logger = subprocess.Popen([sys.executable, os.path.join(ROOT, 'solarmax_logger.py'), path])
+    try:
+        while time.time() - start < timeout:
+            for segment in glob.glob(os.path.join(directory, 'spool', '*.seg')):
+                with open(segment) as f:
+                    line = f.readline()
+                if line.endswith('\n'):
+                    written = time.time()
+                    tick = int(line.split()[-1]) / 1000.0
+                    return (tick - start, written - tick)
+            time.sleep(0.005)
+        raise RuntimeError('No sample within %s seconds' % timeout)
+    finally:
+        logger.kill()
+        logger.wait()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print("{:<32} {:>10} {:>8}".format("import", "ms", "modules"))
+    for (name, statement) in [("interpreter", "pass"),
+                              ("solarmax_logger", "import solarmax_logger"),
+                              ("solarmax_logger + influxdb client", "import solarmax_logger, influxdb")]:
+        try:
+            (seconds, modules) = import_time(statement, rounds)
+        except subprocess.CalledProcessError:
+            print("{:<32} {:>10}".format(name, "not installed"))
+            continue
+        print("{:<32} {:>10.1f} {:>8}".format(name, seconds * 1000, modules))
+
+    ready = multiprocessing.Event()
+    simulator = multiprocessing.Process(target=run_simulator, args=[ready])
+    simulator.daemon = True
+    simulator.start()
+    ready.wait(10)
+
+    directory = tempfile.mkdtemp(prefix='bench_startup')
+    try:
+        (to_tick, to_sample) = first_sample(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        simulator.terminate()
+    # The first run waits for the next whole second, which is part of the first number
+    print("process start to first run: {:.3f}s, first run to sample in spool: {:.3f}s".format(to_tick, to_sample))
+
+
+if __name__ == '__main__':
+    main()
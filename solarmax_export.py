@@ -0,0 +1,166 @@
+#!/usr/bin/python
+import time
+import os
+import sys
+import csv
+import array
+import logging
+from SolarMax.pool import SessionPool
+from SolarMax.discovery import DiscoveryCache
+from SolarMax.store import TimeSeriesStore
+from SolarMax.influx import InfluxWriter
+from SolarMax.supervisor import shard_of
+from solarmax_logger import poll_gateways, line_protocol, read_inverters, influx_settings
+import configparser
+import click
+
+log = logging.getLogger("solarmax_export")
+
+# Energy counters the inverters keep for the current and the previous period
+history_registers = ['KDY', 'KLD', 'KMT', 'KLM', 'KYR', 'KLY', 'KT0']
+
+# measurement -> [(register, period)] the value of the register is the energy of that period
+history_measurements = [
+    ('energy_generation_daily', [('KDY', 'today'), ('KLD', 'yesterday')]),
+    ('energy_generation_monthly', [('KMT', 'month'), ('KLM', 'last_month')]),
+    ('energy_generation_yearly', [('KYR', 'year'), ('KLY', 'last_year')]),
+    ('energy_generation_total', [('KT0', 'now')]),
+]
+
+NAN = float('nan')
+
+
+def period_starts(now):
+    # The counters of the inverters follow local time
+    t = time.localtime(now)
+    y = time.localtime(now - 86400)
+    (last_year, last_month) = (t.tm_year - 1, 12) if t.tm_mon == 1 else (t.tm_year, t.tm_mon - 1)
+    return {
+        'now': now,
+        'today': time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1)),
+        'yesterday': time.mktime((y.tm_year, y.tm_mon, y.tm_mday, 0, 0, 0, 0, 0, -1)),
+        'month': time.mktime((t.tm_year, t.tm_mon, 1, 0, 0, 0, 0, 0, -1)),
+        'last_month': time.mktime((last_year, last_month, 1, 0, 0, 0, 0, 0, -1)),
+        'year': time.mktime((t.tm_year, 1, 1, 0, 0, 0, 0, 0, -1)),
+        'last_year': time.mktime((t.tm_year - 1, 1, 1, 0, 0, 0, 0, 0, -1)),
+    }
+
+
+def history_columns(samples):
+    # One row per inverter, one array per register; missing values are NaN
+    answers = dict(((sample.host, sample.inverter), sample) for sample in samples)
+    rows = sorted(answers.keys())
+    columns = dict()
+    for register in history_registers:
+        columns[register] = array.array('d', [float(answers[row].get(register, NAN)) for row in rows])
+    return (rows, columns)
+
+
+def history_points(rows, columns, now):
+    starts = period_starts(now)
+    points = []
+    for (measurement, periods) in history_measurements:
+        for (register, period) in periods:
+            timestamp = int(starts[period] * 1000)
+            for (row, value) in zip(rows, columns[register]):
+                if value == value:
+                    points.append((measurement, row[0], row[1], timestamp, value))
+
+    # The energy of the month before today and of the year before this month, both
+    # written at the start of their period so they can be compared to the daily sums
+    for (measurement, total, part, period) in [('energy_generation_month_before_today', 'KMT', 'KDY', 'month'),
+                                               ('energy_generation_year_before_month', 'KYR', 'KMT', 'year')]:
+        timestamp = int(starts[period] * 1000)
+        for (row, value) in zip(rows, [a - b for (a, b) in zip(columns[total], columns[part])]):
+            if value == value:
+                points.append((measurement, row[0], row[1], timestamp, value))
+    return points
+
+
+def store_points(stores, inverters, days, now):
+    # Daily energy from the local store: KDY counts up during the day, so the maximum of
+    # a day is what was produced. The store uses UTC days, which hold the whole production
+    # of a local day as long as the sun does not shine at midnight UTC.
+    start = now - days * 86400
+    points = []
+    for host in sorted(inverters.keys()):
+        # With several workers every worker keeps its own store
+        store = stores[shard_of(host, len(stores))]
+        for inverter in inverters[host]:
+            # Stores written before open buckets survived a restart can hold a day twice
+            maxima = {}
+            for rollup in store.query(host, inverter, 'KDY', start, now, '1d'):
+                maxima[rollup[0]] = max(maxima.get(rollup[0], rollup[2]), rollup[2])
+            for day in sorted(maxima.keys()):
+                points.append(('energy_generation_daily', host, inverter, int(day * 1000), maxima[day]))
+    return points
+
+
+def write_points(points, output_format, output, location, writer=None):
+    if output_format == 'csv':
+        out = csv.writer(output)
+        out.writerow(['measurement', 'host_ip', 'inverter', 'timestamp', 'kwh'])
+        for point in points:
+            out.writerow(point)
+        return
+
+    lines = [line_protocol(measurement, host_ip, inverter, location, 'kwh', value, timestamp)
+             for (measurement, host_ip, inverter, timestamp, value) in points]
+    if writer is not None:
+        writer.add(lines)
+        writer.flush()
+    else:
+        output.write('\n'.join(lines) + '\n')
+
+
+@click.command()
+@click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True,
+                                              resolve_path=True))
+@click.option("--format", "output_format", type=click.Choice(['influxdb', 'line', 'csv']), default='line',
+              help="Write the points to InfluxDB or as line protocol or CSV to the output file")
+@click.option("--output", type=click.File('w'), default='-', help="Output file for line protocol or CSV")
+@click.option("--days", type=int, default=0,
+              help="Also export the daily energy of this many days from the local store")
+@click.option("--no-query", is_flag=True, help="Do not query the inverters, only export from the local store")
+def export(configfile, output_format, output, days, no_query):
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format='%(asctime)s - %(name)20s - %(levelname)6s - %(message)s')
+    config = configparser.ConfigParser()
+    config.read([configfile])
+    inverters = read_inverters(config)
+    location = config.get("influxdb", "location")
+    now = time.time()
+
+    points = []
+    if not no_query:
+        host_timeout = config.getint("default", "host_timeout", fallback=30)
+        discovery = DiscoveryCache(config.get("default", "discovery_file", fallback="") or None,
+                                   config.getint("default", "discovery_ttl", fallback=24 * 3600))
+        pool = SessionPool(12345, 1, discovery)
+        samples = poll_gateways(pool, inverters, history_registers, int(now * 1000), host_timeout)
+        pool.close()
+        (rows, columns) = history_columns(samples)
+        log.info("Energy counters of %s inverters retrieved", len(rows))
+        points.extend(history_points(rows, columns, now))
+
+    if days:
+        store_dir = config.get("store", "directory", fallback="")
+        if not store_dir:
+            raise click.UsageError("--days needs a [store] directory in the configuration")
+        workers = config.getint("default", "workers", fallback=1)
+        if workers > 1:
+            stores = [TimeSeriesStore(os.path.join(store_dir, "worker-{}".format(worker)))
+                      for worker in range(workers)]
+        else:
+            stores = [TimeSeriesStore(store_dir)]
+        points.extend(store_points(stores, inverters, days, now))
+
+    writer = None
+    if output_format == 'influxdb':
+        writer = InfluxWriter(*influx_settings(config))
+    write_points(points, output_format, output, location, writer)
+    log.info("Exported %s points", len(points))
+
+
+if __name__ == '__main__':
+    export()
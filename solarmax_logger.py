@@ -1,17 +1,31 @@
 #!/usr/bin/python
+import sys
 import time
 import os
-from influxdb import InfluxDBClient
-from SolarMax.solarmax import SolarMax
+import atexit
+import signal
+from SolarMax.pool import SessionPool
+from SolarMax.discovery import DiscoveryCache
+from SolarMax.registers import RegisterSchedule, parse_register_groups
+from SolarMax.scheduler import AlignedScheduler
+from SolarMax import metrics
+from SolarMax.influx import InfluxWriter, create_client
+from SolarMax.spool import Spool, SpoolDrainer
+from SolarMax.logqueue import queue_logging, QueueHandler, QueueListener
+from SolarMax.supervisor import Supervisor, shard_hosts
+from SolarMax.store import TimeSeriesStore
+from SolarMax.deadband import ChangeFilter, parse_deadbands
+from SolarMax.breaker import CircuitBreaker
+from SolarMax.sample import Sample, LineEncoder
+from SolarMax.reload import ConfigWatcher
 import configparser
 import threading
-import click
 import logging.handlers
 
 log = logging.getLogger("solarmax_logger")
 
 query_dict = {
-    'KDY': 'Energy today (kWh)', 'KDL': 'Energy yesterday (Wh)', 'KYR': 'Energy this year (kWh)',
+    'KDY': 'Energy today (kWh)', 'KLD': 'Energy yesterday (kWh)', 'KYR': 'Energy this year (kWh)',
     'KLY': 'Energy last year (kWh)',
     'KMT': 'Energy this month (kWh)', 'KLM': 'Energy last month (kWh)', 'KT0': 'Total Energy(kWh)',
     'IL1': 'AC Current Phase 1 (A)',
@@ -38,6 +52,20 @@ query_dict = {
 }
 
 
+# register -> (measurement, field) written to influxdb
+measurement_names = {
+    'PAC': ('power_generation', 'watt'), 'UL1': ('voltage', 'ac_volt'),
+    'TKK': ('inverter_temperature', 'celsius'), 'KDY': ('energy_generation_today', 'kwh'),
+    'KMT': ('energy_generation_this_month', 'kwh'), 'KYR': ('energy_generation_this_year', 'kwh'),
+    'KT0': ('energy_generation_total', 'kwh'), 'KLD': ('energy_generation_yesterday', 'kwh'),
+    'KLM': ('energy_generation_last_month', 'kwh'), 'KLY': ('energy_generation_last_year', 'kwh'),
+    'UDC': ('dc_voltage', 'dc_volt'), 'IDC': ('dc_current', 'ampere'), 'IL1': ('ac_current', 'ampere'),
+    'TNF': ('grid_frequency', 'hertz'), 'PRL': ('relative_power', 'percent'), 'PIN': ('installed_power', 'watt'),
+    'KHR': ('operating_hours', 'hours'), 'CAC': ('start_ups', 'count'), 'SAL': ('system_alarms', 'code'),
+    'SYS': ('system_status', 'code'),
+}
+
+
 def init_logger(logdir, loglevel):
     log_formatter = logging.Formatter('%(asctime)s - %(name)20s - %(threadName)10s - %(levelname)6s - %(message)s')
     rootlogger = logging.getLogger()
@@ -48,165 +76,468 @@ def init_logger(logdir, loglevel):
                                                         backupCount=10)
     file_handler.setLevel(loglevel)
     file_handler.setFormatter(log_formatter)
-    rootlogger.addHandler(file_handler)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(loglevel)
     console_handler.setFormatter(log_formatter)
-    rootlogger.addHandler(console_handler)
+
+    # File and console output is written by a background thread
+    (queue_handler, listener) = queue_logging([file_handler, console_handler])
+    rootlogger.addHandler(queue_handler)
     rootlogger.setLevel(loglevel)
+    atexit.register(listener.stop)
+    return listener
+
+
+def query_gateway(pool, host, devices, registers, timestamp, results, pipeline=False, change_filter=None):
+    with pool.session(host, devices) as sm:
+        if not sm.connected():
+            return
+        # Every call detects the inverters again while one of them is missing, once per run is enough
+        found = sorted(sm.inverters().keys())
+        if pipeline:
+            # One burst of queries for all inverters behind this gateway
+            wanted = registers
+            if change_filter is not None:
+                # Same registers for all inverters, idle registers are left out once all of them are idle
+                wanted = set()
+                for inverter in found:
+                    wanted.update(change_filter.registers(sm.host_ip(), inverter, registers))
+                wanted = [r for r in registers if r in wanted]
+                if not wanted:
+                    log.debug("Inverters on %s do not feed in, nothing to query", host)
+                    for inverter in found:
+                        results.append(Sample(sm.host_ip(), inverter, timestamp))
+                    return
+            log.info("Sending query to inverters %s on %s", found, host)
+            answers = sm.query_many(found, wanted)
+            for (inverter, current) in sorted(answers.items()):
+                log.debug("Parsed answer: %s", current)
+                log.info("Successfully retrieved data from inverter %s", inverter)
+                results.append(Sample.from_answer(sm.host_ip(), inverter, timestamp, wanted, current))
+            return
+
+        for inverter in found:
+            try:
+                wanted = registers
+                if change_filter is not None:
+                    wanted = change_filter.registers(sm.host_ip(), inverter, registers)
+                    if not wanted:
+                        log.debug("Inverter #%s on %s does not feed in, nothing to query", inverter, host)
+                        results.append(Sample(sm.host_ip(), inverter, timestamp))
+                        continue
+
+                # Pass the parameters you wish to get from the inverter and log.
+                log.info("Sending query to inverter #%s on %s", inverter, host)
+                (inverter, current) = sm.query(inverter, wanted)
+                log.debug("Parsed answer: %s", current)
 
+                if not current:
+                    log.info("Query to inverter #%s returned no data. Continue to next inverter...", inverter)
+                    continue
 
-def solarmax_logger(inverters, influxdb_host, influxdb_port, database, location, user, password):
-    smlist = []
-    log.info("Start: connect to inverter, query and push metrics Solarmax")
+                log.info("Successfully retrieved data from inverter %s", inverter)
+                results.append(Sample.from_answer(sm.host_ip(), inverter, timestamp, wanted, current))
+
+            except Exception as e:
+                log.exception("Exception with inverter #%s: %s", inverter, e)
+                continue
+
+
+def poll_gateway(pool, host, devices, registers, timestamp, results, pipeline=False, change_filter=None,
+                 breaker=None):
+    if breaker is not None and not breaker.allow(host):
+        return
+    query_gateway(pool, host, devices, registers, timestamp, results, pipeline, change_filter)
+    if breaker is not None:
+        if results:
+            breaker.success(host)
+        else:
+            breaker.failure(host)
+
+
+# host -> (thread, results) of polls that did not finish within their run
+polls_in_flight = {}
+
+
+def poll_gateways(pool, inverters, registers, timestamp, host_timeout, pipeline=False, change_filter=None,
+                  breaker=None):
+    # Every gateway is polled in its own thread, so one dark or unreachable gateway
+    # only costs its own timeout instead of delaying all the others.
+    samples = []
+    for host in list(polls_in_flight.keys()):
+        (thread, results) = polls_in_flight[host]
+        if not thread.is_alive():
+            # Results of a poll that ended after its run, they keep the timestamp of that run
+            del polls_in_flight[host]
+            if host in inverters:
+                log.info("Late answers of gateway %s: %s inverters", host, len(results))
+                samples.extend(results)
+
+    threads = []
     for host in inverters.keys():
-        sm = SolarMax(host, 12345)  # using port 12345
-        if sm.connected():
-            sm.use_inverters(inverters[host])
-            smlist.append(sm)
+        if host in polls_in_flight:
+            # At most one poll per gateway, another one would only queue up behind it
+            log.info("Gateway %s is still busy with an earlier run, skipping it this run", host)
+            continue
+        results = []
+        thread = threading.Thread(name="poll-{}".format(host), target=poll_gateway,
+                                  args=[pool, host, inverters[host], registers, timestamp, results, pipeline,
+                                        change_filter, breaker])
+        thread.setDaemon(True)
+        thread.start()
+        threads.append((host, thread, results))
+
+    deadline = time.time() + host_timeout
+    for (host, thread, results) in threads:
+        thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            log.info("Gateway %s did not answer within %s seconds, collecting its answers next run", host,
+                     host_timeout)
+            polls_in_flight[host] = (thread, results)
+            continue
+        samples.extend(results)
+    return samples
+
+
+def line_protocol(measurement, host_ip, inverter, location, value_name, value, timestamp):
+    return ("{measurement},"
+            "host_ip={host_ip},"  # tag
+            "inverter={inverter},"  # tag
+            "location={location} "  # tag
+            "{value_name}={value} "  # field
+            "{timestamp}".format(measurement=measurement, host_ip=host_ip, inverter=inverter,
+                                 location=location, value_name=value_name, value=value,
+                                 timestamp=timestamp))
+
+
+def solarmax_logger(pool, inverters, sink, location, registers, host_timeout=30, pipeline=False, timestamp=None,
+                    store=None, change_filter=None, breaker=None, encoder=None, cache=None):
+    log.info("Start: connect to inverter, query and push metrics Solarmax (%s)", ','.join(registers))
+    start = time.time()
 
     allinverters = []
     for host in inverters.keys():
         allinverters.extend(inverters[host])
 
     count = 0
-    timestamp = 0
-
-    if smlist:
-        influxdb = InfluxDBClient(influxdb_host, influxdb_port, user, password, database)
-        for sm in smlist:
-            for (inverter, inverter_data) in sm.inverters().iteritems():
-                try:
-                    host_ip = sm.host_ip()
-                    measurements = dict()
-
-                    # Pass the parameters you wish to get from the inverter and log.
-                    log.info("Sending query to inverter #{}".format(inverter))
-                    (inverter, current) = sm.query(inverter, ['PAC', 'UL1', 'TKK', 'KDY', 'KMT', 'KYR', 'KT0'])
-                    log.debug("Parsed answer: {}".format(current))
-
-                    if not current:
-                        log.info("Query to inverter #{} returned no data. Continue to next inverter...".format(
-                            inverter))
-                        continue
 
-                    log.info("Successfully retrieved data from inverter {}".format(inverter))
-
-                    # Use system date/Time for logging.
-                    if not timestamp:
-                        timestamp = int(time.time() * 1000)
-
-                    # Parse the results of sm.query above to human readable variables
-                    measurements["power_generation"] = ["watt", float(current['PAC'])]
-                    measurements["voltage"] = ["ac_volt", float(current['UL1'])]
-                    measurements["inverter_temperature"] = ["celsius", float(current['TKK'])]
-                    measurements["energy_generation_today"] = ["kwh", float(current['KDY'])]
-                    measurements["energy_generation_this_month"] = ["kwh", float(current['KMT'])]
-                    measurements["energy_generation_this_year"] = ["kwh", float(current['KYR'])]
-                    measurements["energy_generation_total"] = ["kwh", float(current['KT0'])]
-
-                    # Write data to influxdb
-                    log.info("Sending measurements from inverter #{} to database...".format(inverter))
-                    for measurement in measurements.keys():
-                        influx_data_points = ("{measurement},"
-                                              "host_ip={host_ip},"  # tag
-                                              "inverter={inverter},"  # tag
-                                              "location={location} "  # tag
-                                              "{value_name}={measurement_value} "  # field
-                                              "{timestamp}".format(measurement=measurement,
-                                                                   host_ip=host_ip, inverter=inverter,
-                                                                   location=location,
-                                                                   value_name=measurements[measurement][0],
-                                                                   measurement_value=measurements[measurement][1],
-                                                                   timestamp=timestamp))
-                        log.debug("Influx data points to send: {}".format(influx_data_points))
-
-                        try:
-                            log.debug("Sending measurement {} to database".format(measurement))
-                            response = influxdb.write_points(influx_data_points, time_precision='ms', protocol='line')
-
-                        except Exception as e:
-                            log.exception("Exception happened sending data from inverter to database: {}".format(e))
-                            continue
-
-                        if response is not True:
-                            log.error("Something went wrong sending measurement from inverter #{} to database.".format(
-                                inverter))
-                            continue
-
-                        log.debug("Influx data points successfully sent to #{}".format(inverter))
-
-                    log.info("Measurements from inverter #{} successfully sent to database".format(inverter))
-
-                    count += 1
-
-                except Exception as e:
-                    log.exception("Exception with inverter #{}:".format(inverter, e))
-                    continue
+    # Use system date/Time for logging, one timestamp for all gateways of this run.
+    if timestamp is None:
+        timestamp = int(time.time() * 1000)
+    samples = poll_gateways(pool, inverters, registers, timestamp, host_timeout, pipeline, change_filter, breaker)
+
+    if encoder is None:
+        encoder = LineEncoder(location, measurement_names)
+    encoder.clear()
+    for sample in samples:
+        try:
+            if store is not None:
+                store.append(sample.host, sample.inverter, sample.timestamp, sample)
+            if cache is not None:
+                cache.update(sample)
+            items = None
+            if change_filter is not None:
+                items = change_filter.filter(sample.host, sample.inverter, sample, sample.timestamp)
+
+            first = len(encoder.buffer)
+            encoder.encode(sample, items)
+            log.debug("Influx data points to send: %s", encoder.buffer[first:])
+            count += 1
+
+        except Exception as e:
+            log.exception("Exception with inverter #%s: %s", sample.inverter, e)
+            continue
+
+    # Write data to influxdb (or the spool in front of it), all points of this run (or flush window) in one batch
+    sink.add(encoder.buffer)
+    sink.flush_due()
 
     if count < len(allinverters):
-        log.info("Not all inverters queried ({} < {})".format(count, len(allinverters)))
+        log.info("Not all inverters queried (%s < %s)", count, len(allinverters))
 
+    duration = time.time() - start
+    metrics.cycle_seconds.observe(duration)
     log.info("End: connect to inverter, query and push metrics Solarmax")
+    return {'timestamp': timestamp, 'inverters': count, 'expected': len(allinverters), 'duration': duration}
 
 
-def sync_loop_solarmax_logger(inverters, influxdb_host, influxdb_port, database, location, user, password):
-    log.info("Solarmax logger started")
-
-    last_log = time.time()
-    next_run = time.time()
+def sync_loop_solarmax_logger(pool, inverters, sink, location, schedule, host_timeout, pipeline, report=None,
+                              store=None, change_filter=None, breaker=None, encoder=None, watcher=None,
+                              cache=None):
+    log.info("Solarmax logger started: %s", schedule)
 
+    scheduler = AlignedScheduler(schedule.period())
+    if encoder is None:
+        encoder = LineEncoder(location, measurement_names)
     while True:
-        log_now = time.time()
-        if (log_now - last_log) > 30:
-            last_log = log_now
-            log.info("Solarmax logger thread active, next run in {} seconds".format(int(next_run - log_now)))
-
-        if time.time() >= next_run:
-            try:
-                solarmax_logger(inverters, influxdb_host, influxdb_port, database, location, user, password)
-
-            except Exception as e:
-                log.exception("Error query and push Solarmax metrics: {}".format(e))
-
-            finally:
-                next_run = time.time() + (60 + 1)
-                log.info("Next Solarmax logger run will be in {} seconds".format(int(next_run - time.time())))
-
-        time.sleep(10)
-
-
-def start_thread_solarmax_logger(inverters, influxdb_host, influxdb_port, database, location, user, password):
+        log.info("Next Solarmax logger run will be in %s seconds", int(scheduler.next_run() - time.time()))
+        tick = scheduler.wait()
+        try:
+            if watcher is not None and watcher.check() and scheduler.period != schedule.period():
+                # New register intervals, the next run is on a boundary of the new period
+                scheduler = AlignedScheduler(schedule.period())
+                continue
+            if breaker is not None and not breaker.daylight(tick):
+                continue
+            registers = schedule.due(tick)
+            if registers:
+                stats = solarmax_logger(pool, inverters, sink, location, registers, host_timeout, pipeline,
+                                        int(tick * 1000), store, change_filter, breaker, encoder, cache)
+                if report is not None:
+                    report(stats)
+
+        except Exception as e:
+            log.exception("Error query and push Solarmax metrics: %s", e)
+
+
+def start_thread_solarmax_logger(pool, inverters, sink, location, schedule, host_timeout, pipeline, report=None,
+                                 store=None, change_filter=None, breaker=None, encoder=None, watcher=None,
+                                 cache=None):
     thread = threading.Thread(name="MainThread", target=sync_loop_solarmax_logger,
-                              args=[inverters, influxdb_host, influxdb_port, database, location, user, password])
+                              args=[pool, inverters, sink, location, schedule, host_timeout, pipeline, report,
+                                    store, change_filter, breaker, encoder, watcher, cache])
     thread.setDaemon(True)
     thread.start()
-    thread.join()
+    # join() with a timeout, signal handlers only run in the main thread between waits
+    while thread.is_alive():
+        thread.join(1)
+
+
+def influx_settings(config):
+    return (config.get("influxdb", "influxdb_host"), config.get("influxdb", "influxdb_port"),
+            config.get("influxdb", "user"), config.get("influxdb", "password"), config.get("influxdb", "database"),
+            config.getint("influxdb", "batch_size", fallback=5000),
+            config.getint("influxdb", "flush_interval", fallback=0),
+            config.getboolean("influxdb", "gzip", fallback=True),
+            config.get("influxdb", "client", fallback="influxdb"))
+
+
+def reload_logger(old, new, inverters, schedule, writer, encoder, pool, worker=None):
+    # Everything is parsed and the new client is built before anything is changed, so a
+    # broken file changes nothing
+    current = read_inverters(new)
+    if worker is not None:
+        current = shard_hosts(current, old.getint("default", "workers", fallback=1))[worker]
+    groups = RegisterSchedule(parse_register_groups(new.items("registers"))
+                              if new.has_section("registers") else None).groups
+    influx = influx_settings(new)
+    location = new.get("influxdb", "location")
+    client = None
+    if influx != influx_settings(old):
+        (host, port, user, password, database, batch_size, flush_interval, gzip, name) = influx
+        client = create_client(name, host, port, user, password, database, gzip)
+
+    # Sessions of the other gateways stay open and keep their detected inverters
+    for host in sorted(set(inverters.keys()) - set(current.keys())):
+        log.info("Gateway %s was removed, closing its connections", host)
+        pool.remove(host)
+    for host in sorted(current.keys()):
+        if host not in inverters:
+            log.info("Gateway %s was added with inverters %s", host, current[host])
+        elif current[host] != inverters[host]:
+            log.info("Inverters of gateway %s changed from %s to %s", host, inverters[host], current[host])
+    inverters.clear()
+    inverters.update(current)
+
+    if [(g.name, g.interval, g.registers) for g in groups] != \
+            [(g.name, g.interval, g.registers) for g in schedule.groups]:
+        schedule.groups = groups
+        log.info("Registers changed: %s", schedule)
+
+    if client is not None:
+        writer.configure(client, batch_size, flush_interval)
+    if location != old.get("influxdb", "location"):
+        log.info("Location changed to %s", location)
+        encoder.set_location(location)
+
+    for section in sorted(set(old.sections()) | set(new.sections())):
+        if section in ("inverters", "registers", "influxdb"):
+            continue
+        if (dict(old.items(section)) if old.has_section(section) else None) != \
+                (dict(new.items(section)) if new.has_section(section) else None):
+            log.warning("Changes to [%s] take effect after a restart", section)
+
+
+def run_logger(config, inverters, worker=None, report=None, configfile=None):
+    host_timeout = config.getint("default", "host_timeout", fallback=30)
+    max_sessions = config.getint("default", "max_sessions", fallback=1)
+    pipeline = config.getboolean("default", "pipeline", fallback=False)
+    metrics_address = config.get("metrics", "address", fallback="127.0.0.1")
+    metrics_port = config.getint("metrics", "port", fallback=0)
+    api_address = config.get("api", "address", fallback="127.0.0.1")
+    api_port = config.getint("api", "port", fallback=0)
+    api_ttl = config.getint("api", "ttl", fallback=30)
+    discovery_file = config.get("default", "discovery_file", fallback="")
+    discovery_ttl = config.getint("default", "discovery_ttl", fallback=24 * 3600)
+    influx = influx_settings(config)
+    location = config.get("influxdb", "location")
+    batch_size = config.getint("influxdb", "batch_size", fallback=5000)
+    flush_interval = config.getint("influxdb", "flush_interval", fallback=0)
+    spool_dir = config.get("spool", "directory", fallback="")
+    segment_bytes = config.getint("spool", "segment_bytes", fallback=1024 * 1024)
+    max_bytes = config.getint("spool", "max_bytes", fallback=100 * 1024 * 1024)
+    max_backoff = config.getint("spool", "max_backoff", fallback=300)
+    store_dir = config.get("store", "directory", fallback="")
+    offline_backoff = config.getint("default", "offline_backoff", fallback=30)
+    offline_max_backoff = config.getint("default", "offline_max_backoff", fallback=1800)
+    latitude = config.get("sun", "latitude", fallback="")
+    longitude = config.get("sun", "longitude", fallback="")
+    min_elevation = config.getfloat("sun", "min_elevation", fallback=-6)
+    heartbeat = config.getint("filter", "heartbeat", fallback=900)
+    idle_registers = [r.strip().upper() for r in config.get("filter", "idle_registers", fallback="").split(',')
+                      if r.strip()]
+    schedule = RegisterSchedule(parse_register_groups(config.items("registers"))
+                                if config.has_section("registers") else None)
+
+    # Every worker process has its own spool, discovery state and metrics port
+    if worker is not None:
+        if spool_dir:
+            spool_dir = os.path.join(spool_dir, "worker-{}".format(worker))
+        if store_dir:
+            store_dir = os.path.join(store_dir, "worker-{}".format(worker))
+        if discovery_file:
+            discovery_file = "{}.{}".format(discovery_file, worker)
+        if metrics_port:
+            metrics_port += 1 + worker
+        if api_port:
+            api_port += 1 + worker
+
+    if metrics_port:
+        metrics.start_metrics_server(metrics_address, metrics_port)
+    writer = InfluxWriter(*influx)
+    if spool_dir:
+        try:
+            sink = Spool(spool_dir, segment_bytes, max_bytes, flush_interval)
+        except (IOError, OSError) as e:
+            log.error("Cannot use spool directory %s, sending points straight to InfluxDB: %s", spool_dir, e)
+            spool_dir = ""
+    if spool_dir:
+        SpoolDrainer(sink, writer, batch_size, max_backoff).start()
+    else:
+        sink = writer
+    discovery = DiscoveryCache(discovery_file or None, discovery_ttl)
+    pool = SessionPool(12345, max_sessions, discovery)  # using port 12345
+    store = None
+    if store_dir:
+        try:
+            store = TimeSeriesStore(store_dir)
+            atexit.register(store.close)
+        except (IOError, OSError) as e:
+            log.error("Cannot use store directory %s, running without the local store: %s", store_dir, e)
+
+    def stop(signum, frame):
+        # systemd stops the service with SIGTERM, which skips atexit (and workers never run it)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        log.info("Stopping on signal %s", signum)
+        if store is not None:
+            store.close()
+        if spool_dir:
+            sink.close()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    change_filter = None
+    if config.has_section("filter"):
+        change_filter = ChangeFilter(parse_deadbands(config.items("deadband")) if config.has_section("deadband")
+                                     else None, heartbeat, idle_registers)
+        log.info("Only changed values are written: %s", change_filter)
+    breaker = CircuitBreaker(offline_backoff, offline_max_backoff, float(latitude) if latitude else None,
+                             float(longitude) if longitude else None, min_elevation)
+    encoder = LineEncoder(location, measurement_names)
+
+    watcher = None
+    if configfile is not None:
+        # The file is checked before every run; SIGHUP makes the next run read it in any case
+        watcher = ConfigWatcher(configfile, config, lambda old, new: reload_logger(
+            old, new, inverters, schedule, writer, encoder, pool, worker))
+        signal.signal(signal.SIGHUP, watcher.request)
+    cache = None
+    if api_port:
+        from SolarMax.api import SampleCache, ReadApi, start_api_server
+        cache = SampleCache(api_ttl)
+        start_api_server(api_address, api_port, ReadApi(pool, inverters, cache))
+    start_thread_solarmax_logger(pool, inverters, sink, location, schedule, host_timeout, pipeline, report, store,
+                                 change_filter, breaker, encoder, watcher, cache)
+
+
+def run_worker(worker, inverters, stats, config, records, configfile=None):
+    # The handler inherited from the supervisor is replaced once the logger is set up
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # Log records go to the supervisor, which owns the log file
+    rootlogger = logging.getLogger()
+    for handler in list(rootlogger.handlers):
+        rootlogger.removeHandler(handler)
+    rootlogger.addHandler(QueueHandler(records))
+    log.info("Worker %s polling %s", worker, sorted(inverters.keys()))
+    run_logger(config, inverters, worker, stats.put, configfile)
+
+
+def run_supervisor(config, inverters, workers, configfile=None):
+    import multiprocessing
+    records = multiprocessing.Queue(10000)
+    QueueListener(records, *logging.getLogger().handlers).start()
+
+    def current_config():
+        config = configparser.ConfigParser()
+        if not config.read([configfile]):
+            raise IOError("Cannot read %s" % configfile)
+        if config.getint("default", "workers", fallback=1) != workers:
+            raise ValueError("Changes to the number of workers take effect after a restart")
+        return (read_inverters(config), (config, records, configfile))
+
+    supervisor = Supervisor(inverters, workers, run_worker, (config, records, configfile),
+                            current_config if configfile is not None else None)
+    # Every worker reloads the configuration by itself, SIGHUP is passed on to them
+    signal.signal(signal.SIGHUP, supervisor.signal)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    log.info("Starting %s", supervisor)
+    supervisor.run()
+
+
+def read_inverters(config):
+    inverters = dict(config.items("inverters"))
+    for host, devices in inverters.items():
+        devices = map(int, devices.split(','))  # convert devices to integers
+        inverters[host] = devices
+    return inverters
 
 
-@click.command()
-@click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True,
-                                              resolve_path=True))
 def process(configfile):
     config = configparser.ConfigParser()
     config.read([configfile])
     logdir = config.get("default", "logdir")
     loglevel = config.get("default", "loglevel")
-    influxdb_host = config.get("influxdb", "influxdb_host")
-    influxdb_port = config.get("influxdb", "influxdb_port")
-    database = config.get("influxdb", "database")
-    location = config.get("influxdb", "location")
-    user = config.get("influxdb", "user")
-    password = config.get("influxdb", "password")
-    inverters = dict(config.items("inverters"))
-    for host, devices in inverters.items():
-        devices = map(int, devices.split(','))  # convert devices to integers
-        inverters[host] = devices
+    workers = config.getint("default", "workers", fallback=1)
+    inverters = read_inverters(config)
 
     init_logger(logdir, loglevel)
-    start_thread_solarmax_logger(inverters, influxdb_host, influxdb_port, database, location, user, password)
+    if workers > 1:
+        run_supervisor(config, inverters, workers, configfile)
+    else:
+        run_logger(config, inverters, configfile=configfile)
     exit()
 
 
+def command():
+    import click
+
+    @click.command()
+    @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True,
+                                                  resolve_path=True))
+    def solarmax_logger_command(configfile):
+        process(configfile)
+    return solarmax_logger_command
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # The service is started with nothing but the configuration file, that needs no
+    # option parsing; click is only loaded for anything else (--help, wrong arguments).
+    if len(argv) == 1 and not argv[0].startswith('-') and os.path.isfile(argv[0]):
+        process(os.path.abspath(argv[0]))
+    else:
+        command()(argv)
+
+
 if __name__ == '__main__':
-    process()
+    main()
@@ -0,0 +1,97 @@
+import gzip
+import io
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from SolarMax.influx import InfluxWriter, LineProtocolError
+
+
+# Stands in for InfluxDB: records every write with its unpacked body and answers
+# with the status the test asks for
+class WriteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        self.server.writes.append((self.path, dict(self.headers.items()), body.decode('utf-8')))
+
+        content = b'' if self.server.status == 204 else b'{"error":"partial write"}'
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WriteServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InfluxWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = WriteServer(('127.0.0.1', 0), WriteHandler)
+        self.server.writes = []
+        self.server.status = 204
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def writer(self, batch_size=5000, user=''):
+        return InfluxWriter('127.0.0.1', self.server.server_address[1], user, 'secret', 'solar',
+                            batch_size=batch_size, client='http')
+
+    def lines(self, count):
+        return ['power_generation,host_ip=10.0.0.1,inverter=1,location=home watt=%s.0 %s' % (i, 1000 + i)
+                for i in range(count)]
+
+    def test_one_request_per_run(self):
+        writer = self.writer(user='logger')
+        writer.add(self.lines(3))
+        writer.flush_due()
+
+        self.assertEqual(len(self.server.writes), 1)
+        (path, headers, body) = self.server.writes[0]
+        self.assertIn('db=solar', path)
+        self.assertIn('precision=ms', path)
+        self.assertTrue(dict((k.lower(), v) for (k, v) in headers.items())['authorization'].startswith('Basic '))
+        self.assertEqual(body, '\n'.join(self.lines(3)) + '\n')
+
+    def test_batch_size_splits_requests(self):
+        writer = self.writer(batch_size=2)
+        writer.add(self.lines(5))
+        writer.flush()
+
+        self.assertEqual([body.count('\n') for (path, headers, body) in self.server.writes], [2, 2, 1])
+        self.assertEqual(''.join(body for (path, headers, body) in self.server.writes),
+                         '\n'.join(self.lines(5)) + '\n')
+
+    def test_error_status_raises(self):
+        self.server.status = 400
+        writer = self.writer()
+        with self.assertRaises(LineProtocolError) as raised:
+            writer.write(self.lines(1))
+        self.assertEqual(raised.exception.code, 400)
+
+        # flush logs the failed batch and carries on
+        writer.add(self.lines(2))
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(len(self.server.writes), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from SolarMax.influx import LineProtocolError
+from SolarMax.spool import Spool, SpoolDrainer
+
+
+# Records the batches it is given, answers with the errors queued in failures first
+class RecordingWriter(object):
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.batches = []
+        self.accepted = []
+        self.lock = threading.Lock()
+
+    def write(self, lines):
+        with self.lock:
+            self.batches.append(list(lines))
+            if self.failures:
+                failure = self.failures.pop(0)
+                if failure is not None:
+                    raise failure
+            self.accepted.extend(lines)
+            return True
+
+
+class SpoolDrainerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_spool')
+        self.spool = Spool(self.directory)
+        self.drainer = None
+
+    def tearDown(self):
+        self.spool.close()
+        if self.drainer is not None:
+            self.drainer.join(5)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def fill(self, segments, lines_per_segment):
+        # One sealed segment per run, as with the default flush_interval = 0
+        lines = []
+        for segment in range(segments):
+            run = ['power_generation,host_ip=10.0.0.1,inverter=1 watt=%s.0 %s' % (line, segment * 1000 + line)
+                   for line in range(lines_per_segment)]
+            self.spool.add(run)
+            self.spool.flush()
+            lines.extend(run)
+        return lines
+
+    def drain(self, writer, batch_size, timeout=10):
+        drainer = self.drainer = SpoolDrainer(self.spool, writer, batch_size, max_backoff=1)
+        drainer.start()
+        deadline = time.time() + timeout
+        while self.spool.wait_segments(0) and time.time() < deadline:
+            time.sleep(0.01)
+        drainer.stop()
+        return [name for name in os.listdir(self.directory) if os.path.getsize(os.path.join(self.directory, name))]
+
+    def test_small_segments_are_combined(self):
+        lines = self.fill(30, 3)
+        writer = RecordingWriter()
+        self.assertEqual(self.drain(writer, batch_size=50), [])
+        self.assertEqual([len(batch) for batch in writer.batches], [48, 42])
+        self.assertEqual(writer.accepted, lines)
+
+    def test_auth_errors_keep_the_points(self):
+        lines = self.fill(4, 5)
+        writer = RecordingWriter([LineProtocolError(401, 'authorization failed'),
+                                  LineProtocolError(404, 'database not found')])
+        self.assertEqual(self.drain(writer, batch_size=100), [])
+        self.assertEqual(len(writer.batches), 3)
+        self.assertEqual(writer.accepted, lines)
+
+    def test_bad_points_only_drop_their_batch(self):
+        lines = self.fill(1, 20)
+        writer = RecordingWriter([LineProtocolError(400, 'unable to parse')])
+        self.assertEqual(self.drain(writer, batch_size=15), [])
+        self.assertEqual([len(batch) for batch in writer.batches], [15, 5])
+        self.assertEqual(writer.accepted, lines[15:])
+
+
+if __name__ == '__main__':
+    unittest.main()
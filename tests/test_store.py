@@ -0,0 +1,91 @@
+import shutil
+import tempfile
+import unittest
+
+from SolarMax.store import TimeSeriesStore
+
+# A UTC midnight, all samples below fall on the same UTC day
+DAY = 19675 * 86400
+
+
+class RollupDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_store')
+        self.store = TimeSeriesStore(self.directory)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def feed(self, store, values, start=DAY + 6 * 3600):
+        # One KDY sample every 60 seconds, the default interval
+        for (i, value) in enumerate(values):
+            store.append('10.0.0.1', 1, int((start + i * 60) * 1000), {'KDY': value})
+
+    def deltas(self, store, resolution):
+        return [record[4] for record in store.query('10.0.0.1', 1, 'KDY', DAY, DAY + 86400, resolution)]
+
+    def test_deltas_add_up_to_the_increase(self):
+        # 0.1 kWh per minute for two hours
+        self.feed(self.store, [i / 10.0 for i in range(121)])
+
+        minutes = self.deltas(self.store, '1m')
+        self.assertEqual(len(minutes), 121)
+        self.assertEqual(minutes[0], 0.0)
+        for delta in minutes[1:]:
+            self.assertAlmostEqual(delta, 0.1)
+
+        quarters = self.deltas(self.store, '15m')
+        self.assertEqual(len(quarters), 9)
+        for delta in quarters[1:-1]:
+            self.assertAlmostEqual(delta, 1.5)
+        self.assertAlmostEqual(sum(quarters), 12.0)
+        self.assertAlmostEqual(sum(self.deltas(self.store, '1d')), 12.0)
+
+    def test_counter_reset(self):
+        # KDY starts over at local midnight, which lies within the UTC day
+        self.feed(self.store, [9.7, 9.8, 9.9, 0.0, 0.0, 0.1, 0.3])
+
+        self.assertEqual(len(self.deltas(self.store, '1d')), 1)
+        self.assertAlmostEqual(self.deltas(self.store, '1d')[0], 0.5)
+        self.assertAlmostEqual(sum(self.deltas(self.store, '15m')), 0.5)
+        self.assertEqual([round(delta, 6) for delta in self.deltas(self.store, '1m')],
+                         [0.0, 0.1, 0.1, 0.0, 0.0, 0.1, 0.2])
+
+    def test_restart_continues_the_buckets(self):
+        values = [i / 10.0 for i in range(31)]
+        self.feed(self.store, values[:17])
+        # Stopped without close(), the open buckets are rebuilt from the raw samples
+        store = TimeSeriesStore(self.directory)
+        self.feed(store, values[17:], DAY + 6 * 3600 + 17 * 60)
+        store.close()
+
+        store = TimeSeriesStore(self.directory)
+        self.assertAlmostEqual(sum(self.deltas(store, '15m')), 3.0)
+        self.assertAlmostEqual(sum(self.deltas(store, '1m')), 3.0)
+        self.assertEqual(len(self.deltas(store, '1d')), 1)
+        self.assertAlmostEqual(self.deltas(store, '1d')[0], 3.0)
+
+
+class OpenFilesTest(unittest.TestCase):
+    def test_more_series_than_open_files(self):
+        directory = tempfile.mkdtemp(prefix='test_store')
+        try:
+            store = TimeSeriesStore(directory, max_open_files=4)
+            registers = ['PAC', 'UDC', 'IDC', 'KDY', 'TKK', 'UL1']
+            for i in range(5):
+                for inverter in (1, 2):
+                    store.append('10.0.0.1', inverter, int((DAY + i * 60) * 1000),
+                                 dict((register, i) for register in registers))
+            store.close()
+            for inverter in (1, 2):
+                for register in registers:
+                    self.assertEqual(store.query('10.0.0.1', inverter, register, DAY, DAY + 86400),
+                                     [(DAY + i * 60, i) for i in range(5)])
+                    self.assertEqual(len(store.query('10.0.0.1', inverter, register, DAY, DAY + 86400, '1m')), 5)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()